@@ -0,0 +1,104 @@
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv as pacsv
+except ImportError:
+    pa = None
+
+'''PyArrow parse backend for Athena DWF CSV files.
+
+pyarrow.csv parses a file in blocks on all cores, and the cleanup that the
+pandas backend does in Python (date and datetime reformatting, nullable
+integers) is done with Arrow compute kernels on whole columns.  The result is handed out as Pandas chunks with the same columns and
+dtypes as transform_dataframe produces, so it feeds the same COPY loader.
+
+The whole file is parsed into Arrow memory at once (Arrow strings are much
+more compact than Python strings, but memory_limit does not apply).
+
+Select it per run with compile_load_plans(..., backend='arrow').
+Requires pyarrow.
+
+Usage:
+    with archive.open('provider_') as member:
+        for df in read_arrow_chunks(member, plan):
+            ...
+'''
+
+# Rows between the header and the data in every Athena DWF CSV
+BANNER_ROWS = 3
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError('The arrow parse backend requires pyarrow (pip install pyarrow)')
+
+def arrow_column_types(plan):
+    '''Map the plan's pandas dtypes to Arrow types. Date and datetime columns are
+    read as strings and parsed afterwards, so invalid values become NULL.'''
+    types = dict()
+    for col, dtype in plan.dtypes.items():
+        if col in plan.date_formats or dtype == str:
+            types[col] = pa.string()
+        elif dtype in ('Int64', int):
+            types[col] = pa.int64()
+        else:
+            types[col] = pa.float64()
+    return types
+
+def read_arrow_table(stream, plan, block_size=None, use_threads=True):
+    '''Parse an Athena DWF CSV with pyarrow.csv, using every core.
+    INPUTS:
+    stream (binary file-like): The CSV, e.g. a FeedArchive member
+    plan (LoadPlan): The compiled plan of the file's prefix
+    block_size (int or None): Bytes per parse block; Arrow's default if None
+    use_threads (bool): Parse blocks in parallel
+    RETURNS:
+    table (pyarrow Table): The plan's CSV columns, in order
+    '''
+    require_pyarrow()
+    read_options = pacsv.ReadOptions(skip_rows_after_names=BANNER_ROWS, use_threads=use_threads)
+    if block_size:
+        read_options.block_size = block_size
+    parse_options = pacsv.ParseOptions(newlines_in_values=True)
+    convert_options = pacsv.ConvertOptions(column_types=arrow_column_types(plan),
+                                           include_columns=plan.csv_columns,
+                                           strings_can_be_null=True)
+    return pacsv.read_csv(stream, read_options=read_options, parse_options=parse_options,
+                          convert_options=convert_options)
+
+def clean_arrow_table(table, plan):
+    '''Apply transform_dataframe's cleanup with Arrow compute kernels:
+    dates and datetimes are parsed with the Athena formats, plan.int_columns are truncated to integers and float ID
+    columns are cast to integers.'''
+    columns = []
+    for name in table.column_names:
+        column = table.column(name)
+        if name in plan.date_formats:
+            in_format, out_format = plan.date_formats[name]
+            column = pc.strptime(column, format=in_format, unit='s', error_is_null=True)
+            if '%H' not in out_format:
+                column = column.cast(pa.date32())
+        elif name in plan.int_columns:
+            column = pc.trunc(column).cast(pa.int64())
+        elif name in plan.id_columns and pa.types.is_floating(column.type):
+            column = column.cast(pa.int64())
+        columns.append(column)
+    return pa.table(columns, names=table.column_names)
+
+def arrow_to_pandas(batch):
+    '''Convert Arrow data to Pandas, with integers as nullable Int64.'''
+    return batch.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+
+def iter_arrow_chunks(table, chunksize=None):
+    '''Yield a table as Pandas dataframes of at most chunksize rows.'''
+    for batch in table.to_batches(max_chunksize=chunksize):
+        yield arrow_to_pandas(batch)
+
+def read_arrow_chunks(stream, plan, block_size=None):
+    '''Parse and clean a whole CSV with Arrow. The stream is read before this
+    returns, so it can be closed while the chunks are consumed.
+    RETURNS:
+    chunks (iterator): Pandas dataframes of at most plan.chunksize rows
+    '''
+    table = clean_arrow_table(read_arrow_table(stream, plan, block_size=block_size), plan)
+    return iter_arrow_chunks(table, plan.chunksize)
@@ -0,0 +1,48 @@
+import csv
+import pandas as pd
+
+'''Fast reader for Athena datawarehousefeed (DWF) CSV files.
+
+Every DWF CSV starts with a header row followed by three banner rows, then the
+data.  Skipping the banner with read_csv's skiprows=lambda x: x in [1, 2, 3]
+makes pandas call a Python function for every line of the file.  Instead, the
+header and banner rows are consumed once from the start of the stream and the
+column names are passed to read_csv, so the C engine parses the rest of the
+file with no per-line callback.  (read_csv's pyarrow engine cannot parse values
+that span lines; athena_arrow_reader uses pyarrow.csv directly instead.)
+
+The banner rows are single physical lines, so they are skipped with readline().
+
+Usage:
+    with archive.open('provider_') as member:
+        df = read_athena_csv(member, dtype=plan.dtypes)
+'''
+
+# Number of banner rows between the header and the data
+BANNER_ROWS = 3
+
+def read_header(stream):
+    '''Consume the header and banner rows from the start of a binary stream.
+    INPUTS:
+    stream (binary file-like): An Athena DWF CSV positioned at its first byte
+    RETURNS:
+    columns (list of strings): The column names from the header row
+    '''
+    header = stream.readline()
+    if not header:
+        raise pd.errors.EmptyDataError('No columns to parse from file')
+    for _ in range(BANNER_ROWS):
+        stream.readline()
+    return next(csv.reader([header.decode('utf-8-sig').rstrip('\r\n')]))
+
+def read_athena_csv(stream, **csv_params):
+    '''pd.read_csv for an Athena DWF CSV: the header and banner rows are read once
+    and only the data rows are handed to the parser.
+    INPUTS:
+    stream (binary file-like): An Athena DWF CSV, e.g. a FeedArchive member
+    csv_params: Any other read_csv kwargs, e.g. dtype or iterator
+    RETURNS:
+    A Pandas dataframe, or a TextFileReader if iterator or chunksize is given
+    '''
+    columns = read_header(stream)
+    return pd.read_csv(stream, header=None, names=columns, **csv_params)
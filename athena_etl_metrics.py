@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import datetime as dt
+from contextlib import contextmanager
+
+'''Per-stage timing and throughput metrics for the Athena ETL.
+
+Every stage of the pipeline (list, download, parse, transform, dates, encode,
+write_csv, copy, swap, commit, drop_indexes, build_indexes, and sftp_to_s3,
+sftp_download and archive in sftp_feed_ingest) is wrapped in stage_timer,
+which adds its wall time, rows and bytes to a running total per
+(key, prefix, stage).  The totals are written out
+at the end of a run as JSON, and optionally as a Prometheus textfile for the
+node_exporter textfile collector.
+
+In the streaming path, COPY pulls chunks through parse, transform and encode,
+so the copy time includes those stages; the time spent in PostgreSQL itself is
+roughly copy - parse - transform - encode.  'dates' is part of 'transform'.
+
+Worker processes keep their own totals; load_prefix_worker returns them with
+drain_stage_metrics and the parent adds them with merge_stage_metrics.
+
+Usage:
+    with metrics_context(key=key, prefix=prefix):
+        with stage_timer('parse') as stage:
+            df = read_athena_csv(member)
+            stage['rows'] = len(df)
+    write_metrics_json('athena_etl_metrics.json')
+'''
+
+# Totals by (key, prefix, stage)
+stage_metrics = dict()
+
+# Labels applied to stages that don't name their own key or prefix
+_context = {'key': None, 'prefix': None}
+
+# Default for the key and prefix of a stage: take them from metrics_context.
+# Pass None instead for a stage that has no key or prefix, e.g. one running in
+# another thread.
+INHERIT = object()
+
+@contextmanager
+def metrics_context(**labels):
+    '''Label every stage timed inside the block with a key and/or prefix.'''
+    previous = dict(_context)
+    _context.update(labels)
+    try:
+        yield
+    finally:
+        _context.clear()
+        _context.update(previous)
+
+def add_stage(stage, seconds, rows=0, nbytes=0, calls=1, key=INHERIT, prefix=INHERIT):
+    '''Add one measurement to the totals of (key, prefix, stage).'''
+    labels = (_context['key'] if key is INHERIT else key,
+              _context['prefix'] if prefix is INHERIT else prefix,
+              stage)
+    totals = stage_metrics.setdefault(labels, {'seconds': 0.0, 'rows': 0, 'bytes': 0, 'calls': 0})
+    totals['seconds'] += seconds
+    totals['rows'] += rows
+    totals['bytes'] += nbytes
+    totals['calls'] += calls
+
+@contextmanager
+def stage_timer(stage, key=INHERIT, prefix=INHERIT):
+    '''Time a block as one call of a stage. The block can set 'rows' and 'bytes'
+    on the yielded dict; they are recorded even if the block raises.'''
+    counts = {'rows': 0, 'bytes': 0}
+    start = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        add_stage(stage, time.perf_counter() - start, rows=counts['rows'], nbytes=counts['bytes'],
+                  key=key, prefix=prefix)
+
+def drain_stage_metrics():
+    '''Return and reset this process's totals, e.g. to send them to the parent.'''
+    records = [dict(totals, key=key, prefix=prefix, stage=stage)
+               for (key, prefix, stage), totals in stage_metrics.items()]
+    stage_metrics.clear()
+    return records
+
+def merge_stage_metrics(records):
+    '''Add totals drained from another process. Records without a key or prefix
+    take the labels of the current metrics_context.'''
+    for record in records:
+        key = INHERIT if record['key'] is None else record['key']
+        prefix = INHERIT if record['prefix'] is None else record['prefix']
+        add_stage(record['stage'], record['seconds'], rows=record['rows'], nbytes=record['bytes'],
+                  calls=record['calls'], key=key, prefix=prefix)
+
+def stage_rows():
+    '''The totals as a list of dicts, with rows/sec and bytes/sec, slowest first.'''
+    rows = []
+    for (key, prefix, stage), totals in stage_metrics.items():
+        seconds = totals['seconds']
+        rows.append(dict(totals, key=key, prefix=prefix, stage=stage,
+                         rows_per_sec=totals['rows'] / seconds if seconds else None,
+                         bytes_per_sec=totals['bytes'] / seconds if seconds else None))
+    return sorted(rows, key=lambda row: row['seconds'], reverse=True)
+
+def print_stage_metrics(limit=20):
+    '''Print the slowest (key, prefix, stage) totals.'''
+    for row in stage_rows()[:limit]:
+        print('{stage:<10} {prefix!s:<26} {seconds:8.2f}s {rows:>10} rows {bytes:>13} bytes  {key}'.format(**row))
+
+def write_metrics_json(path, **run_labels):
+    '''Write the totals as JSON, with any run_labels (e.g. feed_version) at the top level.'''
+    document = dict(run_labels, generated_at=dt.datetime.now(dt.timezone.utc).isoformat(), stages=stage_rows())
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2, default=str)
+
+def write_prometheus_textfile(path):
+    '''Write the totals, summed over keys, in the Prometheus text format.
+    Keys are left out of the labels so the number of series stays fixed. The file
+    is written to a temporary name and renamed, as the textfile collector requires.'''
+    by_prefix = dict()
+    for (key, prefix, stage), totals in stage_metrics.items():
+        summed = by_prefix.setdefault((prefix, stage), {'seconds': 0.0, 'rows': 0, 'bytes': 0})
+        for name in summed:
+            summed[name] += totals[name]
+    lines = []
+    for name, help_text in [('seconds', 'Wall time spent in the stage'),
+                            ('rows', 'Rows processed by the stage'),
+                            ('bytes', 'Bytes processed by the stage')]:
+        metric = 'athena_etl_stage_{}'.format(name)
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} gauge'.format(metric))
+        for (prefix, stage), summed in sorted(by_prefix.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+            lines.append('{}{{stage="{}",prefix="{}"}} {}'.format(metric, stage, prefix or '', summed[name]))
+    lines.append('# HELP athena_etl_last_run_timestamp_seconds When the metrics were written')
+    lines.append('# TYPE athena_etl_last_run_timestamp_seconds gauge')
+    lines.append('athena_etl_last_run_timestamp_seconds {}'.format(time.time()))
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(temp_path, path)
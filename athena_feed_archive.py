@@ -0,0 +1,65 @@
+import zipfile
+
+'''A feed zip opened once and indexed by Athena file prefix.
+
+Each datawarehousefeed zip holds one CSV per Athena table, named
+<prefix><feed version><timestamp>_<id>.csv.  FeedArchive parses the zip's
+central directory a single time, maps every member to its prefix from
+athena_file_dict, and hands out streaming readers for the members so that all
+prefix loaders for a key can share one open archive.
+
+Usage:
+    with FeedArchive(zip_path, file_dict.keys()) as archive:
+        if 'provider_' in archive:
+            member = archive.open('provider_')
+'''
+
+class FeedArchive(object):
+
+    def __init__(self, path, prefixes):
+        '''Open and index a feed zip.
+        INPUTS:
+        path (str): The path/filename of the zip file
+        prefixes (iterable of strings): The Athena file prefixes to look for,
+        e.g. the keys of athena_file_dict.get_dictionary()
+        '''
+        self.path = path
+        self.zip_ref = zipfile.ZipFile(path, 'r')
+        # Check longer prefixes first so a member is matched to its most specific prefix
+        prefixes = sorted(prefixes, key=len, reverse=True)
+        self.members = dict()
+        for info in self.zip_ref.infolist():
+            for prefix in prefixes:
+                if info.filename.startswith(prefix):
+                    self.members[prefix] = info
+                    break
+
+    def __contains__(self, prefix):
+        return prefix in self.members
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def prefixes(self):
+        '''The prefixes that have a member in this zip.'''
+        return list(self.members.keys())
+
+    def filename(self, prefix):
+        '''The member file name for a prefix. Raises KeyError if it is missing.'''
+        return self.members[prefix].filename
+
+    def file_size(self, prefix):
+        '''The uncompressed size of the member for a prefix, or 0 if it is missing.'''
+        info = self.members.get(prefix)
+        return info.file_size if info is not None else 0
+
+    def open(self, prefix):
+        '''Return a binary stream of the member for a prefix without extracting it.
+        Raises KeyError if the prefix is not in the zip.'''
+        return self.zip_ref.open(self.members[prefix])
+
+    def close(self):
+        self.zip_ref.close()
@@ -0,0 +1,170 @@
+import os
+import shutil
+import datetime as dt
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+'''Where feed zips are read from: S3, an S3-compatible object store (e.g. a
+local MinIO), or a local directory.
+
+Every source lists keys the same way S3 does (in lexicographic order, with
+start_after and stop_after applied while listing), describes each object with
+'Key', 'ETag', 'Size' and 'LastModified', and can download an object or open
+it as a binary stream; opening a key that does not exist raises KeyError in
+every source.  Keys are relative to the source's root with '/' separators: a
+local directory, or the bucket (or the key prefix in 's3://bucket/prefix'), so
+'processed/athenaftp/datawarehousefeed_17.3_...zip' names the same feed in
+every source.
+
+A local directory has no ETag; it uses the file's size and modification time
+instead, so a file that is replaced is loaded again, like a re-uploaded key.
+Local files are loaded in place rather than copied (see local_path).
+
+Usage:
+    source = make_feed_source('s3://dispatchhealthdata')
+    source = make_feed_source('s3://dispatchhealthdata', endpoint_url='http://localhost:9000')
+    source = make_feed_source('s3://dispatchhealthdata/archive')   # keys under archive/
+    source = make_feed_source('/mnt/nvme/athena')
+    for obj in source.iter_objects('processed/athenaftp/datawarehousefeed_17.3_'):
+        print(obj['Key'], obj['Size'])
+'''
+
+# Multipart settings for feed zip downloads: 16MB parts fetched by 10 threads
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=16 * 1024 * 1024,
+                                 multipart_chunksize=16 * 1024 * 1024,
+                                 max_concurrency=10,
+                                 use_threads=True)
+
+class FeedSource(object):
+    '''The interface shared by the feed sources.'''
+
+    def iter_objects(self, prefix, start_after=None, stop_after=None):
+        '''Yield the metadata of every object under a prefix in key order.
+        INPUTS:
+        prefix (str): Only keys beginning with prefix are listed.
+        start_after (str or None): Only keys sorting after this string are listed.
+        stop_after (str or None): Stop once a key sorts after this string.
+        RETURNS:
+        A generator of dicts with 'Key', 'ETag', 'Size' and 'LastModified'
+        '''
+        raise NotImplementedError
+
+    def download(self, key, filename):
+        '''Save an object to a local file.'''
+        raise NotImplementedError
+
+    def open(self, key):
+        '''Return a binary, read-only stream of an object. Raises KeyError if
+        there is no such object.'''
+        raise NotImplementedError
+
+    def local_path(self, key):
+        '''The path of an object that can be read in place, or None if it must be downloaded.'''
+        return None
+
+class S3FeedSource(FeedSource):
+
+    def __init__(self, bucket, root='', client=None, endpoint_url=None, config=TRANSFER_CONFIG):
+        '''A bucket on S3, or on an S3-compatible store when endpoint_url is given.
+        INPUTS:
+        bucket (str): The name of the bucket
+        root (str): A key prefix that keys are relative to, e.g. 'archive/'
+        client: A boto3 S3 client; one is created if None
+        endpoint_url (str or None): e.g. 'http://localhost:9000' for MinIO
+        config (TransferConfig): The multipart download settings
+        '''
+        self.bucket = bucket
+        self.root = root.strip('/') + '/' if root.strip('/') else ''
+        self.client = client if client is not None else boto3.client('s3', endpoint_url=endpoint_url)
+        self.config = config
+
+    def __repr__(self):
+        return 's3://{}/{}'.format(self.bucket, self.root)
+
+    def iter_objects(self, prefix, start_after=None, stop_after=None):
+        paginator = self.client.get_paginator('list_objects_v2')
+        operation_parameters = {'Bucket': self.bucket, 'Prefix': self.root + prefix}
+        if start_after:
+            operation_parameters['StartAfter'] = self.root + start_after
+        for page in paginator.paginate(**operation_parameters):
+            for obj in page.get('Contents', []):
+                key = obj['Key'][len(self.root):]
+                if stop_after is not None and key > stop_after:
+                    return
+                yield {'Key': key,
+                       'ETag': obj['ETag'].strip('"'),
+                       'Size': obj['Size'],
+                       'LastModified': obj['LastModified']}
+
+    def download(self, key, filename):
+        self.client.download_file(Bucket=self.bucket, Key=self.root + key, Filename=filename, Config=self.config)
+
+    def open(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.root + key)['Body']
+        except self.client.exceptions.NoSuchKey:
+            raise KeyError(key)
+
+class LocalFeedSource(FeedSource):
+
+    def __init__(self, root):
+        '''A local directory laid out like the bucket.
+        INPUTS:
+        root (str): The directory that keys are relative to
+        '''
+        self.root = os.path.abspath(root)
+
+    def __repr__(self):
+        return self.root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def iter_objects(self, prefix, start_after=None, stop_after=None):
+        # Only walk the directory that holds the prefix, e.g. processed/athenaftp/
+        directory, _, name_prefix = prefix.rpartition('/')
+        top = self.path(directory) if directory else self.root
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(top):
+            relative = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            relative = '' if relative == '.' else relative + '/'
+            keys.extend(relative + filename for filename in filenames)
+        for key in sorted(keys):
+            if not key.startswith(prefix) or (start_after and key <= start_after):
+                continue
+            if stop_after is not None and key > stop_after:
+                return
+            stat = os.stat(self.path(key))
+            yield {'Key': key,
+                   'ETag': '{:x}-{:x}'.format(stat.st_size, stat.st_mtime_ns),
+                   'Size': stat.st_size,
+                   'LastModified': dt.datetime.fromtimestamp(stat.st_mtime, dt.timezone.utc)}
+
+    def download(self, key, filename):
+        shutil.copyfile(self.path(key), filename)
+
+    def open(self, key):
+        try:
+            return open(self.path(key), 'rb')
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def local_path(self, key):
+        return self.path(key)
+
+def make_feed_source(location, endpoint_url=None, client=None):
+    '''Create the feed source for a location.
+    INPUTS:
+    location (str): 's3://<bucket>' for a bucket, 's3://<bucket>/<prefix>' for the
+    keys under a prefix, or a local directory
+    endpoint_url (str or None): The endpoint of an S3-compatible store
+    client: An existing boto3 S3 client to use for a bucket
+    RETURNS:
+    source (FeedSource)
+    '''
+    if location.startswith('s3://'):
+        bucket, _, root = location[len('s3://'):].partition('/')
+        return S3FeedSource(bucket, root=root, client=client, endpoint_url=endpoint_url)
+    if not os.path.isdir(location):
+        raise ValueError('{} is not an s3:// location or a directory'.format(location))
+    return LocalFeedSource(location)
@@ -1,17 +1,25 @@
 '''Store information for each Athena data import as JSON object.
 For each file, include:
 prefix: The root key of the JSON object and the prefix to identify the CSV file in the Athena DWH feed
-columns: A dictionary of the CSV variable names as keys and their data types as values
+columns: A dictionary of the CSV variable names as keys and their data types as values.
+ID columns use pandas' nullable 'Int64' dtype so that missing IDs are loaded as NULL.
 rename: A dictionary of CSV variable as keys and PostgreSQL variables as values if the variable should be
 renamed.  Note that by default, the program turns Camel case to Snake case E.G. 'Created Datetime' = 'created_datetime'.
 If no variables are renamed, set this to an emtpy dictionary E.G. 'rename': dict()
 postgres_table: The name of the Postgres table to hold the data.
+load_mode (optional): 'append' (the default) to COPY rows straight into the table, 'upsert' to COPY
+into a staging table and merge on primary_key with a single INSERT ... ON CONFLICT DO UPDATE (a feed
+older than the newest one in the load manifest only inserts missing keys), or
+'replace' for reference snapshots: each feed is loaded into a new unindexed table that is indexed,
+analyzed and swapped in for the live table (see pg_table_swap).  A feed older than the newest one
+in the load manifest is not swapped in.
+primary_key (optional): A list of the Postgres primary key columns, as defined in create_tables.sql.
 '''
 def get_dictionary():
     file_dict = {
       'provider_': {
         'columns':{
-          'Provider ID':int,
+          'Provider ID':'Int64',
           'Provider First Name':str,
           'Provider Last Name':str,
           'Provider User Name':str,
@@ -19,21 +27,23 @@ def get_dictionary():
           'Provider Type Name':str,
           'Provider Type Category':str,
           'Provider NPI Number':str,
-          'Provider Group ID':int,
-          'Supervising Provider ID':int,
+          'Provider Group ID':'Int64',
+          'Supervising Provider ID':'Int64',
           'Taxonomy':str,
           'Specialty':str,
           'Created Datetime':str,
           'Deleted By':str
         },
         'rename': dict(),
-        'postgres_table': 'athenadwh_provider_clone'
+        'postgres_table': 'athenadwh_provider_clone',
+        'load_mode': 'replace',
+        'primary_key': ['provider_id']
         },
         'patientpastmedicalhistory': {
           'columns':{
-            'Past Medical History ID':int,
-            'Patient ID':float,
-            'Chart ID':int,
+            'Past Medical History ID':'Int64',
+            'Patient ID':'Int64',
+            'Chart ID':'Int64',
             'Past Medical History Key':str,
             'Past Medical History Question':str,
             'Past Medical History Answer':str,
@@ -46,13 +56,15 @@ def get_dictionary():
             'Past Medical History Question':'question',
             'Past Medical History Answer':'answer'
           },
-          'postgres_table': 'athenadwh_medical_history_clone'
+          'postgres_table': 'athenadwh_medical_history_clone',
+          'load_mode': 'upsert',
+          'primary_key': ['id']
         },
         'patientsocialhistory': {
           'columns':{
-            'Social History ID':int,
-            'Patient ID':int,
-            'Chart ID':int,
+            'Social History ID':'Int64',
+            'Patient ID':'Int64',
+            'Chart ID':'Int64',
             'Social History Key':str,
             'Social History Name':str,
             'Social History Answer':str,
@@ -64,13 +76,15 @@ def get_dictionary():
             'Social History Name':'question',
             'Social History Answer':'answer'
           },
-          'postgres_table': 'athenadwh_social_history_clone'
+          'postgres_table': 'athenadwh_social_history_clone',
+          'load_mode': 'upsert',
+          'primary_key': ['id']
         },
         'clinicalresult_': {
           'columns':{
-            'Clinical Result ID':int,
-            'Document ID':int,
-            'Clinical Provider ID':float,
+            'Clinical Result ID':'Int64',
+            'Document ID':'Int64',
+            'Clinical Provider ID':'Int64',
             'Specimen Source':str,
             'Clinical Order Type':str,
             'Clinical Order Type Group':str,
@@ -79,32 +93,35 @@ def get_dictionary():
             'Created By':str
             },
           'rename': dict(),
-          'postgres_table': 'athenadwh_clinical_results_clone'
+          'postgres_table': 'athenadwh_clinical_results_clone',
+          'load_mode': 'upsert',
+          'primary_key': ['clinical_result_id']
         },
         'document_': {
           'columns':{
-            'Document ID':int,
-            'Patient ID':float,
-            'Chart ID':float
+            'Document ID':'Int64',
+            'Patient ID':'Int64',
+            'Chart ID':'Int64'
           },
           'rename':dict(),
           'postgres_table': 'athenadwh_document_crosswalk_clone'
         },
         'clinicalprovider_': {
           'columns': {
-            'Clinical Provider ID': int,
+            'Clinical Provider ID': 'Int64',
             'Fax': str
           },
           'rename': dict(),
-          'postgres_table': 'athenadwh_clinical_providers_fax_clone'
+          'postgres_table': 'athenadwh_clinical_providers_fax_clone',
+          'load_mode': 'replace'
         },
         'clinicalencounter_': {
           'columns': {
-            'Clinical Encounter ID': int,
-            'Patient ID': int,
-            'Chart ID': int,
-            'Appointment ID': float,
-            'Provider ID': int,
+            'Clinical Encounter ID': 'Int64',
+            'Patient ID': 'Int64',
+            'Chart ID': 'Int64',
+            'Appointment ID': 'Int64',
+            'Provider ID': 'Int64',
             'Encounter Date': str,
             'Encounter Status': str,
             'Created Datetime': str,
@@ -112,13 +129,15 @@ def get_dictionary():
             'Closed By': str
           },
           'rename': dict(),
-          'postgres_table': 'athenadwh_clinical_encounters_clone_full'
+          'postgres_table': 'athenadwh_clinical_encounters_clone_full',
+          'load_mode': 'upsert',
+          'primary_key': ['clinical_encounter_id']
         },
         'medication_': {
           'columns': {
-            'Medication ID': int,
+            'Medication ID': 'Int64',
             'Medication Name': str,
-            'FDB Med ID': float,
+            'FDB Med ID': 'Int64',
             'Med Name ID': float,
             'RxNorm': str,
             'NDC':str,
@@ -126,22 +145,24 @@ def get_dictionary():
             'HIC3 Description': str,
             'HIC1 Code': str,
             'HIC1 Description': str,
-            'GCN Clinical Forumulation ID': float,
+            'GCN Clinical Forumulation ID': 'Int64',
             'HIC2 Pharmacological Class': str,
             'HIC4 Ingredient Base': str,
             'DEA Schedule': str,
           },
           'rename': dict(),
-          'postgres_table': 'athenadwh_medication_clone'
+          'postgres_table': 'athenadwh_medication_clone',
+          'load_mode': 'replace',
+          'primary_key': ['medication_id']
         },
         'patientmedication_': {
           'columns': {
-            'Patient Medication ID': int,
+            'Patient Medication ID': 'Int64',
             'Medication Type': str,
-            'Patient ID': float,
-            'Chart ID': float,
-            'Document ID': float,
-            'Medication ID': float,
+            'Patient ID': 'Int64',
+            'Chart ID': 'Int64',
+            'Document ID': 'Int64',
+            'Medication ID': 'Int64',
             'Sig': str,
             'Medication Name': str,
             'Dosage Form': str,
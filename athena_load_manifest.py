@@ -0,0 +1,106 @@
+import re
+from psycopg2 import sql
+from pg_connection_pool import pg_connection
+
+'''Track which feed files have already been loaded so reruns and backfills
+only download and load new or changed zips.
+
+The manifest table holds one row per (S3 key, ETag, prefix) that has been
+loaded, see athenadwh_load_manifest in create_tables.sql.  A manifest entry is
+written in the same transaction as the COPY it describes, so a failed load
+never leaves a manifest row behind.
+'''
+
+def get_load_manifest(manifest_table, dbhost, dbname, dbuser, dbpw):
+    '''Read the manifest table.
+    INPUTS:
+    manifest_table (str): schema.table of the manifest
+    db<credential>: The Postgres login and database credentials.
+    RETURNS:
+    loaded (set): A set of (s3_key, etag, prefix) tuples already loaded
+    '''
+    query = sql.SQL('SELECT s3_key, etag, prefix FROM {}').format(sql.Identifier(*manifest_table.split('.')))
+    with pg_connection(dbhost, dbname, dbuser, dbpw) as conn:
+        with conn.cursor() as cur:
+            cur.execute(query)
+            loaded = set(cur.fetchall())
+        conn.rollback()
+    return loaded
+
+def average_rows_by_prefix(manifest_table, dbhost, dbname, dbuser, dbpw):
+    '''The average number of rows per feed file of each prefix, from past loads.
+    RETURNS:
+    averages (dict): Average row_count by prefix, for prefixes loaded with rows
+    '''
+    query = sql.SQL('SELECT prefix, avg(row_count) FROM {} WHERE row_count > 0 GROUP BY prefix').format(
+        sql.Identifier(*manifest_table.split('.')))
+    with pg_connection(dbhost, dbname, dbuser, dbpw) as conn:
+        with conn.cursor() as cur:
+            cur.execute(query)
+            averages = {prefix: float(rows) for prefix, rows in cur.fetchall()}
+        conn.rollback()
+    return averages
+
+def pending_prefixes(loaded, key, etag, prefixes):
+    '''Return the prefixes of a key that have not been loaded for this ETag.
+    A key that was re-uploaded with different content gets a new ETag and is
+    therefore loaded again.'''
+    return [prefix for prefix in prefixes if (key, etag, prefix) not in loaded]
+
+def filter_new_files(objects, loaded, prefixes):
+    '''Diff an S3 listing against the manifest.
+    INPUTS:
+    objects (list of dicts): S3 object metadata with 'Key' and 'ETag'
+    loaded (set): The result of get_load_manifest
+    prefixes (list of strings): The Athena file prefixes that should be loaded
+    RETURNS:
+    todo (list of tuples): (object, prefixes still to load) for each new or changed file
+    '''
+    todo = []
+    for obj in objects:
+        remaining = pending_prefixes(loaded, obj['Key'], obj['ETag'], prefixes)
+        if remaining:
+            todo.append((obj, remaining))
+    return todo
+
+# The feed date (YYYYMMDD) in a key such as
+# processed/athenaftp/datawarehousefeed_17.3_20181104080514_13869.zip
+FEED_DATE_PATTERN = 'datawarehousefeed_[^_/]+_([0-9]{8})'
+
+def feed_key_date(key):
+    '''The feed date of a feed zip key as YYYYMMDD, or None if it has none.'''
+    match = re.search(FEED_DATE_PATTERN, key)
+    return match.group(1) if match else None
+
+def newer_feed_loaded(cur, manifest):
+    '''Whether the manifest already has the prefix loaded from a feed with a later
+    feed date than manifest['key'], using an open cursor.
+    INPUTS:
+    manifest (dict): 'table', 'key' and 'prefix' of the load
+    RETURNS: bool
+    '''
+    query = sql.SQL('SELECT EXISTS (SELECT 1 FROM {} WHERE prefix = %s AND substring(s3_key from %s) > %s)').format(
+        sql.Identifier(*manifest['table'].split('.')))
+    cur.execute(query, (manifest['prefix'], FEED_DATE_PATTERN, feed_key_date(manifest['key'])))
+    return cur.fetchone()[0]
+
+def insert_manifest_row(cur, manifest, rows):
+    '''Record a load using an open cursor, inside the caller's transaction.
+    INPUTS:
+    cur: A psycopg2 cursor
+    manifest (dict): 'table', 'key', 'etag' and 'prefix' of the load
+    rows (int): The number of rows loaded
+    '''
+    query = sql.SQL('''INSERT INTO {} (s3_key, etag, prefix, row_count, load_timestamp)
+    VALUES (%s, %s, %s, %s, now())
+    ON CONFLICT (s3_key, etag, prefix) DO UPDATE
+      SET row_count = excluded.row_count,
+          load_timestamp = excluded.load_timestamp''').format(sql.Identifier(*manifest['table'].split('.')))
+    cur.execute(query, (manifest['key'], manifest['etag'], manifest['prefix'], rows))
+
+def record_load(manifest, rows, dbhost, dbname, dbuser, dbpw):
+    '''Record a load in its own transaction, e.g. for a prefix that is not in the zip.'''
+    with pg_connection(dbhost, dbname, dbuser, dbpw) as conn:
+        with conn.cursor() as cur:
+            insert_manifest_row(cur, manifest, rows)
+        conn.commit()
@@ -0,0 +1,123 @@
+from psycopg2 import sql
+from pg_table_swap import swap_table_name
+
+'''Per-prefix load plans compiled once from athena_file_dict.
+
+A LoadPlan holds everything about a prefix that does not change from one feed
+zip to the next: the CSV columns and dtypes, the read_csv arguments, the
+Postgres table and columns, the date/datetime, ID and integer columns that need
+converting, the load mode and primary key, and the COPY statement.  Plans are built once at
+startup with compile_load_plans and reused for every key of a run or backfill,
+instead of re-deriving the same lists for every prefix of every zip and
+re-scanning column names on every dataframe.
+
+LoadPlan objects are plain data and can be pickled to worker processes.
+
+Usage:
+    plans = compile_load_plans(file_dict, 'looker_scratch', intlist, chunksize=100000)
+    plan = plans['provider_']
+    df = read_athena_csv(member, **plan.csv_args)
+'''
+
+# Input and output formats of Athena date and datetime columns, by column name suffix
+DATE_FORMAT = ('%m/%d/%Y', '%Y-%m-%d')
+DATETIME_FORMAT = ('%m/%d/%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S')
+
+PARSE_BACKENDS = ('pandas', 'arrow')
+
+# How a prefix's rows reach its table, see athena_file_dict
+LOAD_MODES = ('append', 'upsert', 'replace')
+
+def find_date_formats(columns):
+    '''Map each date or datetime column to its (input format, output format).
+    Date columns end in 'Date' and datetime columns end in 'Datetime'.'''
+    formats = dict()
+    for col in columns:
+        if col[-8:] == 'Datetime':
+            formats[col] = DATETIME_FORMAT
+        elif col[-4:] == 'Date':
+            formats[col] = DATE_FORMAT
+    return formats
+
+def find_id_columns(columns):
+    '''Return the ID columns, i.e. the columns ending in 'ID'.'''
+    return [col for col in columns if col[-2:] == 'ID']
+
+def staging_table_name(dbtable):
+    '''The name of the temporary staging table used to upsert into dbtable.'''
+    return 'staging_' + dbtable.split('.')[-1]
+
+def copy_statement(dbtable, columns):
+    '''COPY FROM STDIN for the tab separated text format rows written by ChunkedCSVStream.'''
+    return sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT text, DELIMITER E'\\t', NULL '')").format(
+        sql.Identifier(*dbtable.split('.')),
+        sql.SQL(', ').join(map(sql.Identifier, columns)))
+
+class LoadPlan(object):
+
+    def __init__(self, file_dict, prefix, dbschema=None, intlist=(), chunksize=None, backend='pandas'):
+        '''Compile the load plan of one prefix.
+        INPUTS:
+        file_dict (dict): The dictionary from athena_file_dict.get_dictionary()
+        prefix (str): The Athena file prefix, e.g. 'provider_'
+        dbschema (str or None): The Postgres schema of the target table
+        intlist (list of strings): Integer columns that are read as floats
+        chunksize (int or None): Rows per chunk when the file is streamed
+        backend (str): 'pandas' to parse with the pandas C engine, or 'arrow' to
+        parse with pyarrow.csv on all cores (see athena_arrow_reader)
+        '''
+        if backend not in PARSE_BACKENDS:
+            raise ValueError('Unknown parse backend {!r}, expected one of {}'.format(backend, PARSE_BACKENDS))
+        entry = file_dict[prefix]
+        self.load_mode = entry.get('load_mode', 'append')
+        if self.load_mode not in LOAD_MODES:
+            raise ValueError('Unknown load mode {!r} for {}, expected one of {}'.format(self.load_mode, prefix, LOAD_MODES))
+        d = entry['columns']
+        r = entry['rename'] or dict()
+        self.prefix = prefix
+        self.csv_columns = list(d.keys())
+        self.dtypes = dict(d)
+        # Character variables, excluding any that are not datetime
+        # DEPRECATED USING psycopg2 copy_from
+        self.charvars = [k for k, v in d.items() if v == str and 'Datetime' not in k]
+        # The header and banner rows are skipped by athena_dwf_reader.read_athena_csv
+        self.csv_args = {'dtype': self.dtypes}
+        self.chunksize = chunksize
+        self.backend = backend
+        # Convert Camel case with spaces to snake case and rename columns as needed
+        self.pgcols = [r[key] if key in r else key.replace(' ', '_').lower() for key in d.keys()]
+        self.add_feed_date = prefix == 'provider_'
+        if self.add_feed_date:
+            self.pgcols.append('feed_date')
+        self.date_formats = find_date_formats(self.csv_columns)
+        # Free text columns, the only ones that can hold newlines, tabs or backslashes
+        self.text_columns = [k for k, v in d.items() if v == str and k not in self.date_formats]
+        self.id_columns = find_id_columns(self.csv_columns)
+        self.int_columns = [col for col in self.csv_columns if col in intlist]
+        self.postgres_table = entry['postgres_table']
+        self.dbtable = dbschema + '.' + self.postgres_table if dbschema else self.postgres_table
+        self.primary_key = entry['primary_key'] if self.load_mode == 'upsert' else None
+        # Upserts COPY into the staging table, full refreshes into the table to be
+        # swapped in, appends straight into the table
+        if self.load_mode == 'upsert':
+            self.copy_target = staging_table_name(self.dbtable)
+        elif self.load_mode == 'replace':
+            self.copy_target = swap_table_name(self.dbtable)
+        else:
+            self.copy_target = self.dbtable
+        self.copy_sql = copy_statement(self.copy_target, self.pgcols)
+
+    def __repr__(self):
+        return 'LoadPlan({!r} -> {})'.format(self.prefix, self.dbtable)
+
+    def chunked_csv_args(self):
+        '''read_csv arguments for reading the file chunksize rows at a time.'''
+        return dict(self.csv_args, chunksize=self.chunksize)
+
+def compile_load_plans(file_dict, dbschema=None, intlist=(), chunksize=None, backend='pandas'):
+    '''Compile a LoadPlan for every prefix in file_dict.
+    RETURNS:
+    plans (dict): LoadPlan by prefix
+    '''
+    return {prefix: LoadPlan(file_dict, prefix, dbschema=dbschema, intlist=intlist, chunksize=chunksize, backend=backend)
+            for prefix in file_dict}
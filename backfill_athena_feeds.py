@@ -0,0 +1,108 @@
+import os
+import argparse
+import datetime as dt
+import athena_file_dict
+from athena_feed_source import make_feed_source
+from athena_load_plan import compile_load_plans, PARSE_BACKENDS
+from athena_load_manifest import get_load_manifest, filter_new_files
+from pg_connection_pool import print_pool_metrics
+from athena_etl_metrics import print_stage_metrics, write_metrics_json, write_prometheus_textfile
+from import_athena_csv_to_postgres import (FEED_PREFIXES, INT_COLUMNS, list_feed_objects,
+                                           order_feed_objects, load_new_feed_files)
+
+'''Backfill the Athena datawarehousefeed zips of a range of feed dates.
+
+Keys are listed for the date range, ordered by feed date and loaded one zip
+at a time, with the next zip downloading in the background and the prefixes
+of the current zip loaded by a pool of worker processes.
+
+Every (key, prefix) that is loaded is checkpointed in the load manifest in
+the same transaction as its COPY.  An interrupted backfill is resumed by
+running the same command again: committed prefixes are skipped and loading
+restarts with the first missing one.
+
+Usage:
+    python backfill_athena_feeds.py 20181020 20181105
+    python backfill_athena_feeds.py 20181020 20181105 --feed-version _17.3_ --prefixes provider_ medication_
+    python backfill_athena_feeds.py 20181020 20181105 --dry-run
+    python backfill_athena_feeds.py 20181020 20181105 --source /mnt/nvme/athena
+
+The Postgres password is read from PGPASSWORD (or ~/.pgpass) unless --dbpw is given.
+'''
+
+def feed_date(value):
+    '''argparse type for a YYYYMMDD feed date.'''
+    try:
+        dt.datetime.strptime(value, '%Y%m%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not a YYYYMMDD date'.format(value))
+    return value
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Backfill Athena feed zips between two feed dates, inclusive.')
+    parser.add_argument('start_date', type=feed_date, help='First feed date, YYYYMMDD')
+    parser.add_argument('end_date', type=feed_date, help='Last feed date, YYYYMMDD')
+    parser.add_argument('--feed-version', default='_17.3_')
+    parser.add_argument('--prefixes', nargs='+', default=FEED_PREFIXES)
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Prefixes loaded at once (one process and one connection each)')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--memory-limit-mb', type=int, default=512,
+                        help='Memory ceiling for the chunks of each worker (0 for fixed size chunks)')
+    parser.add_argument('--backend', choices=PARSE_BACKENDS, default='pandas')
+    parser.add_argument('--defer-indexes', choices=('never', 'auto', 'always'), default='never',
+                        help='Drop secondary indexes during the backfill and rebuild them concurrently afterwards '
+                             '(auto: only for tables that get many rows compared with their size)')
+    parser.add_argument('--atomic', action='store_true',
+                        help='Load each zip in one transaction on one connection (ignores --workers)')
+    parser.add_argument('--bucket', default='dispatchhealthdata')
+    parser.add_argument('--source', help='s3://<bucket>[/<prefix>] or a local directory laid out like the bucket (overrides --bucket)')
+    parser.add_argument('--endpoint-url', help='Endpoint of an S3-compatible store, e.g. http://localhost:9000 for MinIO')
+    parser.add_argument('--s3prefix', default='processed/athenaftp/')
+    parser.add_argument('--location', default='/home/ubuntu/', help='Where the zips are downloaded to')
+    parser.add_argument('--manifest-table', default='looker_scratch.athenadwh_load_manifest')
+    parser.add_argument('--dbhost', default=os.environ.get('PGHOST', 'dashboard-clone.cylxp8fwq9cz.us-west-2.rds.amazonaws.com'))
+    parser.add_argument('--dbname', default=os.environ.get('PGDATABASE', 'dashboard'))
+    parser.add_argument('--dbschema', default='looker_scratch')
+    parser.add_argument('--dbuser', default=os.environ.get('PGUSER', 'bi_user'))
+    parser.add_argument('--dbpw', default=os.environ.get('PGPASSWORD'))
+    parser.add_argument('--metrics-json', help='Write per-stage timings to this JSON file')
+    parser.add_argument('--prometheus-textfile', help='Write per-stage timings to this node_exporter textfile')
+    parser.add_argument('--dry-run', action='store_true', help='List what would be loaded and exit')
+    args = parser.parse_args(argv)
+    if args.start_date > args.end_date:
+        parser.error('start_date is after end_date')
+    unknown = set(args.prefixes) - set(athena_file_dict.get_dictionary())
+    if unknown:
+        parser.error('unknown prefixes: {}'.format(', '.join(sorted(unknown))))
+    return args
+
+def print_pending(objects, loaded, prefixes, feed_version):
+    '''Print the keys and prefixes a backfill would load.'''
+    todo = filter_new_files(order_feed_objects(objects, feed_version), loaded, prefixes)
+    for obj, remaining in todo:
+        print('{}: {}'.format(obj['Key'], ', '.join(remaining)))
+    print('{} of {} feed files need loading'.format(len(todo), len(objects)))
+
+if __name__ == '__main__':
+    args = parse_args()
+    creds = {'dbhost': args.dbhost, 'dbname': args.dbname, 'dbuser': args.dbuser, 'dbpw': args.dbpw}
+    source = make_feed_source(args.source or 's3://' + args.bucket, endpoint_url=args.endpoint_url)
+    objects = list_feed_objects(source, args.s3prefix, args.feed_version,
+                                start_date=args.start_date, end_date=args.end_date)
+    if args.dry_run:
+        print_pending(objects, get_load_manifest(args.manifest_table, **creds), args.prefixes, args.feed_version)
+    else:
+        plans = compile_load_plans(athena_file_dict.get_dictionary(), args.dbschema, INT_COLUMNS,
+                                   chunksize=args.chunksize, backend=args.backend)
+        memory_limit = args.memory_limit_mb * 1024 * 1024 if args.memory_limit_mb else None
+        load_new_feed_files(source, objects, args.prefixes, plans, args.feed_version, args.location,
+                            args.workers, args.manifest_table, memory_limit=memory_limit, atomic=args.atomic,
+                            defer_indexes=args.defer_indexes, **creds)
+        print_pool_metrics()
+        print_stage_metrics()
+        if args.metrics_json:
+            write_metrics_json(args.metrics_json, feed_version=args.feed_version,
+                               start_date=args.start_date, end_date=args.end_date)
+        if args.prometheus_textfile:
+            write_prometheus_textfile(args.prometheus_textfile)
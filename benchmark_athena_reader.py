@@ -0,0 +1,56 @@
+import io
+import time
+import zipfile
+import pandas as pd
+import athena_file_dict
+from athena_dwf_reader import read_athena_csv
+from athena_arrow_reader import read_arrow_table, pa
+from athena_load_plan import LoadPlan
+from synthetic_athena_feed import make_feed_csv
+
+'''Benchmark the Athena DWF reader against the original skiprows lambda.
+Reads either a prefix of a real feed zip, or a synthetic file with the columns
+of that prefix, with both readers and checks they return the same dataframe.
+With pandas' C engine parsing time dominates, so expect little or no gain:
+1.0x on clinicalencounter_ and 0.9x on patientmedication_ when last measured.
+Usage:
+    python benchmark_athena_reader.py [prefix] [num_rows]
+    python benchmark_athena_reader.py prefix path/to/datawarehousefeed.zip
+'''
+
+def read_skiprows(stream, dtype):
+    '''The original reader, kept here as the benchmark baseline.'''
+    return pd.read_csv(stream, header=0, skiprows=lambda x: x in [1, 2, 3], dtype=dtype)
+
+def time_it(func, data, dtype, **kwargs):
+    start = time.perf_counter()
+    df = func(io.BytesIO(data), dtype=dtype, **kwargs)
+    return time.perf_counter() - start, df
+
+if __name__ == '__main__':
+    import sys
+    prefix = sys.argv[1] if len(sys.argv) > 1 else 'clinicalencounter_'
+    source = sys.argv[2] if len(sys.argv) > 2 else '1000000'
+    dtype = athena_file_dict.get_dictionary()[prefix]['columns']
+    if source.endswith('.zip'):
+        with zipfile.ZipFile(source) as zip_ref:
+            name = [n for n in zip_ref.namelist() if n.startswith(prefix)][0]
+            data = zip_ref.read(name)
+    else:
+        data = make_feed_csv(prefix, int(source))
+    baseline, expected = time_it(read_skiprows, data, dtype)
+    fast, actual = time_it(read_athena_csv, data, dtype)
+    pd.testing.assert_frame_equal(expected, actual)
+    print('{}: {} rows, {:.1f} MB'.format(prefix, len(actual), len(data) / 1e6))
+    # The per-line callback is cheap next to parsing: expect about 1.0x here
+    print('skiprows lambda: {:.2f}s'.format(baseline))
+    print('header skip:     {:.2f}s'.format(fast))
+    print('speedup:         {:.1f}x'.format(baseline / fast))
+    # read_csv(engine='pyarrow') cannot parse values that span lines, so the
+    # arrow backend calls pyarrow.csv directly (see athena_arrow_reader)
+    if pa is not None:
+        plan = LoadPlan(athena_file_dict.get_dictionary(), prefix)
+        start = time.perf_counter()
+        read_arrow_table(io.BytesIO(data), plan)
+        arrow = time.perf_counter() - start
+        print('pyarrow.csv:     {:.2f}s ({:.1f}x)'.format(arrow, baseline / arrow))
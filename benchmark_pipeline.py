@@ -0,0 +1,149 @@
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import psycopg2
+from psycopg2 import sql
+import athena_file_dict
+import import_athena_csv_to_postgres as loader
+from athena_feed_archive import FeedArchive
+from athena_load_plan import compile_load_plans, PARSE_BACKENDS
+from athena_etl_metrics import drain_stage_metrics
+from synthetic_athena_feed import write_feed_zip, parse_prefix_rows
+
+'''Benchmark the parse, transform and load stages on a synthetic (or real)
+feed zip, without production S3 or RDS.
+
+Each prefix is loaded in a fresh process so its peak RSS can be measured on
+its own.  With --dbname the rows are loaded into a local Postgres: a scratch
+schema (athena_bench by default) is created with one table per prefix, built
+from the load plans, and dropped again at the end.  Without --dbname the COPY
+text is produced and discarded, which measures everything except Postgres.
+
+Usage:
+    python benchmark_pipeline.py --rows 200000
+    python benchmark_pipeline.py --rows 200000 --backend arrow --dbname bench --dbuser postgres
+    python benchmark_pipeline.py --zip datawarehousefeed_17.3_20181104080514_13869.zip --dbname bench
+'''
+
+PG_TYPES = {'Int64': 'bigint', int: 'bigint', float: 'double precision', str: 'text'}
+
+def pg_type(col, dtype):
+    '''The Postgres type of a benchmark table column.'''
+    if col[-8:] == 'Datetime':
+        return 'timestamp'
+    if col[-4:] == 'Date':
+        return 'date'
+    return PG_TYPES[dtype]
+
+def create_benchmark_tables(plans, prefixes, dbschema, creds):
+    '''(Re)create the scratch schema with a table for each prefix, matching the
+    load plan's columns and the primary key from athena_file_dict.'''
+    file_dict = athena_file_dict.get_dictionary()
+    conn = psycopg2.connect(host=creds['dbhost'], dbname=creds['dbname'], user=creds['dbuser'], password=creds['dbpw'])
+    with conn, conn.cursor() as cur:
+        cur.execute(sql.SQL('DROP SCHEMA IF EXISTS {} CASCADE').format(sql.Identifier(dbschema)))
+        cur.execute(sql.SQL('CREATE SCHEMA {}').format(sql.Identifier(dbschema)))
+        for prefix in prefixes:
+            plan = plans[prefix]
+            columns = [sql.SQL('{} {}').format(sql.Identifier(pgcol), sql.SQL(pg_type(col, plan.dtypes[col])))
+                       for col, pgcol in zip(plan.csv_columns, plan.pgcols)]
+            if plan.add_feed_date:
+                columns.append(sql.SQL('feed_date date'))
+            primary_key = file_dict[prefix].get('primary_key')
+            if primary_key:
+                columns.append(sql.SQL('PRIMARY KEY ({})').format(sql.SQL(', ').join(map(sql.Identifier, primary_key))))
+            cur.execute(sql.SQL('CREATE TABLE {} ({})').format(sql.Identifier(dbschema, plan.postgres_table),
+                                                            sql.SQL(', ').join(columns)))
+    conn.close()
+
+def drop_benchmark_schema(dbschema, creds):
+    conn = psycopg2.connect(host=creds['dbhost'], dbname=creds['dbname'], user=creds['dbuser'], password=creds['dbpw'])
+    with conn, conn.cursor() as cur:
+        cur.execute(sql.SQL('DROP SCHEMA IF EXISTS {} CASCADE').format(sql.Identifier(dbschema)))
+    conn.close()
+
+def peak_rss_mb():
+    '''Peak resident set size of this process in MB (ru_maxrss is KB on Linux, bytes on macOS).'''
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == 'darwin' else maxrss / 1024
+
+def run_prefix(zip_path, plans, prefix, feed_version, creds, memory_limit):
+    '''Load (or just encode) one prefix in this process.
+    RETURNS:
+    result (dict): rows, seconds, peak_rss_mb and the per-stage seconds
+    '''
+    plan = plans[prefix]
+    start = time.perf_counter()
+    with FeedArchive(zip_path, plans.keys()) as archive:
+        if creds:
+            rows = loader.stream_archive_to_postgres(archive, plan, feed_version, memory_limit=memory_limit, **creds)
+        else:
+            stream = loader.open_prefix_stream(archive, plan, feed_version, memory_limit=memory_limit)
+            while stream.read(1024 * 1024):
+                pass
+            rows = stream.rows
+    seconds = time.perf_counter() - start
+    stages = dict()
+    for record in drain_stage_metrics():
+        stages[record['stage']] = stages.get(record['stage'], 0.0) + record['seconds']
+    return {'prefix': prefix, 'rows': rows, 'seconds': seconds, 'peak_rss_mb': peak_rss_mb(), 'stages': stages}
+
+def print_results(results):
+    stages = ['parse', 'transform', 'dates', 'encode', 'copy']
+    print('{:<26} {:>9} {:>8} {:>10} {:>9}  '.format('prefix', 'rows', 'seconds', 'rows/sec', 'peak MB') +
+          ' '.join('{:>9}'.format(stage) for stage in stages))
+    for result in results:
+        rate = result['rows'] / result['seconds'] if result['seconds'] else 0
+        print('{prefix:<26} {rows:>9} {seconds:8.2f} '.format(**result) + '{:>10.0f} {:>9.0f}  '.format(rate, result['peak_rss_mb']) +
+              ' '.join('{:>9.2f}'.format(result['stages'].get(stage, 0.0)) for stage in stages))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the Athena ETL on a synthetic feed zip.')
+    parser.add_argument('--zip', help='Benchmark this feed zip instead of generating one')
+    parser.add_argument('--rows', type=int, default=100000, help='Rows per prefix of the generated zip')
+    parser.add_argument('--prefix-rows', nargs='*', help='Per prefix row counts, e.g. document_=1000000')
+    parser.add_argument('--prefixes', nargs='+', default=list(athena_file_dict.get_dictionary()))
+    parser.add_argument('--feed-version', default='_17.3_')
+    parser.add_argument('--backend', choices=PARSE_BACKENDS, default='pandas')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--memory-limit-mb', type=int, default=512)
+    parser.add_argument('--dbhost', default='localhost')
+    parser.add_argument('--dbname', help='Load into this local database; without it COPY text is discarded')
+    parser.add_argument('--dbuser', default=os.environ.get('PGUSER', 'postgres'))
+    parser.add_argument('--dbpw', default=os.environ.get('PGPASSWORD'))
+    parser.add_argument('--dbschema', default='athena_bench')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='athena_bench_')
+    try:
+        zip_path = args.zip
+        if not zip_path:
+            start = time.perf_counter()
+            zip_path = write_feed_zip(workdir, '20181104', args.rows, parse_prefix_rows(args.prefix_rows),
+                                      feed_version=args.feed_version, prefixes=args.prefixes)
+            print('generated {} in {:.1f}s'.format(zip_path, time.perf_counter() - start))
+        plans = compile_load_plans(athena_file_dict.get_dictionary(), args.dbschema, loader.INT_COLUMNS,
+                                   chunksize=args.chunksize, backend=args.backend)
+        creds = None
+        if args.dbname:
+            creds = {'dbhost': args.dbhost, 'dbname': args.dbname, 'dbuser': args.dbuser, 'dbpw': args.dbpw}
+            create_benchmark_tables(plans, args.prefixes, args.dbschema, creds)
+        memory_limit = args.memory_limit_mb * 1024 * 1024 if args.memory_limit_mb else None
+        # A fresh spawned process per prefix, so peak RSS is measured per prefix
+        context = multiprocessing.get_context('spawn')
+        results = []
+        for prefix in args.prefixes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                results.append(executor.submit(run_prefix, zip_path, plans, prefix, args.feed_version,
+                                               creds, memory_limit).result())
+        print_results(results)
+        if creds:
+            drop_benchmark_schema(args.dbschema, creds)
+    finally:
+        shutil.rmtree(workdir)
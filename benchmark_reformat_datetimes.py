@@ -0,0 +1,49 @@
+import time
+import numpy as np
+import pandas as pd
+import import_athena_csv_to_postgres as loader
+
+'''Benchmark the date/datetime reformatting stage on a clinicalencounter_ sized
+dataframe, comparing the original per-row date_func/datetime_func path with the
+vectorized convert_date_strings path used by reformat_datetimes.
+Usage: python benchmark_reformat_datetimes.py [num_rows]
+'''
+
+def make_encounter_dates(num_rows, seed=13869):
+    '''Build a dataframe with the date columns of a clinicalencounter_ file.
+    Roughly 10% of the closed datetimes are missing, as in the real feed.'''
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2016-01-01')
+    days = pd.to_timedelta(rng.integers(0, 1000, num_rows), unit='D')
+    seconds = pd.to_timedelta(rng.integers(0, 86400, num_rows), unit='s')
+    encounter = (start + days).strftime('%m/%d/%Y')
+    created = (start + days + seconds).strftime('%m/%d/%Y %H:%M:%S')
+    closed = pd.Series((start + days + seconds + pd.Timedelta(hours=2)).strftime('%m/%d/%Y %H:%M:%S'))
+    closed[rng.random(num_rows) < 0.1] = np.nan
+    return pd.DataFrame({'Encounter Date': encounter,
+                         'Created Datetime': created,
+                         'Closed Datetime': closed})
+
+def reformat_datetimes_per_row(df):
+    '''The original implementation, kept here as the benchmark baseline.'''
+    for dc in ['Encounter Date']:
+        df[dc] = df[dc].apply(loader.date_func)
+    for dtc in ['Created Datetime', 'Closed Datetime']:
+        df[dtc] = df[dtc].apply(loader.datetime_func)
+    return df
+
+def time_it(func, df):
+    start = time.perf_counter()
+    func(df.copy())
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    import sys
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    df = make_encounter_dates(num_rows)
+    per_row = time_it(reformat_datetimes_per_row, df)
+    vectorized = time_it(loader.reformat_datetimes, df)
+    print('rows: {}'.format(num_rows))
+    print('per-row strptime: {:.2f}s'.format(per_row))
+    print('vectorized:       {:.2f}s'.format(vectorized))
+    print('speedup:          {:.1f}x'.format(per_row / vectorized))
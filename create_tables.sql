@@ -253,3 +253,20 @@ CREATE TABLE IF NOT EXISTS oversight_provider (
 GRANT SELECT, INSERT, UPDATE, DELETE
   ON oversight_provider
   TO looker;
+
+# Records each (S3 key, ETag, prefix) that has been loaded so reruns skip it
+CREATE TABLE IF NOT EXISTS looker_scratch.athenadwh_load_manifest (
+  s3_key VARCHAR(500),
+  etag VARCHAR(100),
+  prefix VARCHAR(50),
+  row_count BIGINT,
+  load_timestamp TIMESTAMP,
+  PRIMARY KEY (s3_key, etag, prefix));
+
+# Secondary indexes dropped for a bulk load, kept until they are rebuilt
+CREATE TABLE IF NOT EXISTS looker_scratch.athenadwh_deferred_indexes (
+  table_name VARCHAR(200),
+  index_name VARCHAR(100),
+  index_definition TEXT,
+  dropped_timestamp TIMESTAMP,
+  PRIMARY KEY (table_name, index_name));
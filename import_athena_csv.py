@@ -6,6 +6,8 @@ import os
 import shutil
 import datetime
 import zipfile
+from pg_connection_pool import pg_connection, copy_timer
+from pg_binary_copy import copy_dataframe_binary
 
 '''Basic workflow:
 1. Instantiate s3 client object (assumes aws credentials have been set.
@@ -39,11 +41,7 @@ def get_s3_keys(s3_obj, bucket, prefix=None, substring=None):
     operation_parameters = {'Bucket': bucket,
                             'Prefix': prefix}
     page_iterator = paginator.paginate(**operation_parameters)
-    d = dict()
-    for page in page_iterator:
-        d.update(page)
-
-    key_list = [d['Contents'][k]['Key'] for k in range(len(d['Contents']))]
+    key_list = [obj['Key'] for page in page_iterator for obj in page.get('Contents', [])]
     if substring is not None:
         key_list = [sub for sub in key_list if substring in sub]
     return key_list
@@ -125,13 +123,28 @@ def load_tuples_to_postgres(db_table, columns, data, dbhost, dbname, dbschema, d
     columns (tuple of strings): A tuple containing the PostgreSQL table names to insert.
     RETURNS: None
     '''
-    connection = psycopg2.connect(host=dbhost,
-                                 dbname=dbname,
-                                 user=dbuser,
-                                 password=dbpw)
-    mgr = CopyManager(connection, dbschema + '.' + db_table, columns)
-    mgr.copy(data)
-    connection.commit()
+    with pg_connection(dbhost, dbname, dbuser, dbpw) as connection:
+        mgr = CopyManager(connection, dbschema + '.' + db_table, columns)
+        with copy_timer():
+            mgr.copy(data)
+        connection.commit()
+
+def load_dataframe_to_postgres(db_table, columns, df, dfcols, dbhost, dbname, dbschema, dbuser, dbpw):
+    '''Load a dataframe to a table in PostgreSQL using binary COPY.
+    Columns are encoded straight from their NumPy arrays by pg_binary_copy,
+    without building a list of tuples or encoding strings cell by cell.
+    INPUTS:
+    db_table (str): The table in which to insert values.
+    columns (tuple of strings): A tuple containing the PostgreSQL table names to insert.
+    df (Pandas dataframe): The data to load
+    dfcols (list of strings): The dataframe columns matching columns
+    db<credential>: The Postgres login, database and schema credentials.
+    RETURNS: None
+    '''
+    with pg_connection(dbhost, dbname, dbuser, dbpw) as connection:
+        with connection.cursor() as cur, copy_timer():
+            copy_dataframe_binary(cur, dbschema + '.' + db_table, df, dfcols, columns)
+        connection.commit()
 
 def load_csv_files_to_pg(s3_obj, keys, bucket, s3prefix, s3columns, localzipfile, csv_args, dbtable, dbcolumns, dbhost, dbname, dbschema, dbuser, dbpw):
     """ For a list of keys, read CSV files and load the results to a PostgreSQL
@@ -142,9 +155,7 @@ def load_csv_files_to_pg(s3_obj, keys, bucket, s3prefix, s3columns, localzipfile
         filename, df = read_csv_from_zip(localzipfile, s3prefix, csv_params=csv_args)
         if not df.empty:
             df = reformat_datetime(df, ['Created Datetime'])
-            df = encode_to_binary(df, medical_char)
-            tuples = df_to_tuples(df, s3columns)
-            load_tuples_to_postgres(dbtable, dbcolumns, tuples, dbhost, dbname, dbschema, dbuser, dbpw)
+            load_dataframe_to_postgres(dbtable, dbcolumns, df, s3columns, dbhost, dbname, dbschema, dbuser, dbpw)
         os.remove(filename)
 
 if __name__ == '__main__':
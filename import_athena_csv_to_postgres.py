@@ -1,14 +1,30 @@
 import pandas as pd
-import boto3
+import numpy as np
 from pgcopy import CopyManager, Replace
-import psycopg2
 from psycopg2 import sql
 import os
+import time
+import csv
 import shutil
 import datetime as dt
 from datetime import timedelta
-import zipfile
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import athena_file_dict
+from pg_connection_pool import pg_connection, copy_timer, print_pool_metrics
+from athena_feed_archive import FeedArchive
+from athena_feed_source import S3FeedSource, make_feed_source, TRANSFER_CONFIG
+from pg_table_swap import table_identifier, create_swap_table, swap_in_table
+from pg_deferred_indexes import (should_defer_indexes, table_row_estimate, drop_secondary_indexes, deferred_indexes,
+                                 rebuild_deferred_indexes)
+from athena_load_manifest import (get_load_manifest, filter_new_files, pending_prefixes, insert_manifest_row, record_load,
+                                  average_rows_by_prefix, newer_feed_loaded)
+from athena_dwf_reader import read_athena_csv
+from athena_arrow_reader import read_arrow_chunks
+from athena_etl_metrics import (stage_timer, metrics_context, drain_stage_metrics, merge_stage_metrics,
+                                print_stage_metrics, write_metrics_json, write_prometheus_textfile)
+from athena_load_plan import LoadPlan, compile_load_plans, find_date_formats, find_id_columns, staging_table_name, copy_statement
 
 '''Basic workflow:
 1. Instantiate s3 client object (assumes aws credentials have been set.
@@ -22,23 +38,52 @@ Use the AWS CLI in order to set AWS key and secret_key)
 4. Extract the required CSV file
 5. Use psycopg2 copy_from to copy the data to the database table
 7. Use os to remove locally loaded files
+
+For backfills over a date range, use backfill_athena_feeds.py.
 '''
 
+# The Athena files loaded by default
+FEED_PREFIXES = ['clinicalprovider_', 'provider_', 'clinicalencounter_', 'document_', 'patientsocialhistory', 'patientpastmedicalhistory',
+                 'medication_', 'patientmedication_']
+# Integer columns with missing values, read as floats (see replace_missing_ints)
+INT_COLUMNS = ['Dosage Quantity', 'Prescription Fill Quantity', 'Number of Refills Prescribed']
+
 # DEPRECATED
 def get_s3_keys(s3_obj, bucket, prefix=None, substring=None):
-    #Use pagination in case there are more than the 1000 result limit
-    paginator = s3_obj.get_paginator('list_objects')
-    operation_parameters = {'Bucket': bucket,
-                            'Prefix': prefix}
-    page_iterator = paginator.paginate(**operation_parameters)
-    d = dict()
-    for page in page_iterator:
-        d.update(page)
-
-    key_list = [d['Contents'][k]['Key'] for k in range(len(d['Contents']))]
-    if substring is not None:
-        key_list = [sub for sub in key_list if substring in sub]
-    return key_list
+    return s3_list_files(s3_obj, bucket, prefix, substring=substring)
+
+def iter_s3_objects(s3_obj, bucket_name, prefix, start_after=None, stop_after=None):
+    '''Yield the metadata of every object under a prefix using list_objects_v2.
+    Keys are returned by S3 in lexicographic order, which lets the listing start
+    and stop on the server side instead of filtering the whole prefix.
+    INPUTS:
+    s3_obj: The name of the instantiated s3 client object.
+    bucket_name (str): The name of the S3 bucket.
+    prefix (str): Only keys beginning with prefix are listed.
+    start_after (str or None): Only keys sorting after this string are listed.
+    stop_after (str or None): Stop once a key sorts after this string.
+    RETURNS:
+    A generator of dicts with 'Key', 'ETag', 'Size' and 'LastModified'
+    '''
+    return S3FeedSource(bucket_name, client=s3_obj).iter_objects(prefix, start_after=start_after, stop_after=stop_after)
+
+def iter_feed_objects(source, s3prefix, feed_version, start_date=None, end_date=None):
+    '''Yield the feed zips of one feed version between two feed dates, inclusive.
+    Feed zips are named datawarehousefeed<feed_version>YYYYMMDDHHMMSS_<id>.zip,
+    so the dates translate directly into StartAfter and a stopping key.
+    INPUTS:
+    source (FeedSource): Where the feeds are listed from, see athena_feed_source
+    s3prefix (str): The sub-folder holding the feeds, e.g. 'processed/athenaftp/'
+    feed_version (str): The feed version, e.g. '_17.3_'
+    start_date, end_date (str or None): Feed dates as YYYYMMDD
+    RETURNS:
+    A generator of dicts with 'Key', 'ETag', 'Size' and 'LastModified'
+    '''
+    prefix = s3prefix + 'datawarehousefeed' + feed_version
+    start_after = prefix + start_date if start_date else None
+    # '~' sorts after every digit, so all keys of end_date are included
+    stop_after = prefix + end_date + '~' if end_date else None
+    return source.iter_objects(prefix, start_after=start_after, stop_after=stop_after)
 
 def s3_list_files(s3_obj, bucket_name, prefix, substring=None):
     '''Get the list of keys (filenames) from an AWS S3 bucket.
@@ -52,30 +97,100 @@ def s3_list_files(s3_obj, bucket_name, prefix, substring=None):
     RETURNS:
     key_list (list): A list of all keys in the S3 bucket/bucket+sub_folder
     '''
-    paginator = s3_obj.get_paginator("list_objects")
+    return [obj['Key'] for obj in s3_list_objects(s3_obj, bucket_name, prefix, substring=substring)]
 
-    page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
-    keys = []
-    for page in page_iterator:
-        if "Contents" in page:
-            for key in page["Contents"]:
-                keyString = key["Key"]
-                if substring is not None:
-                    if substring in keyString:
-                        keys.append(keyString)
+def s3_list_objects(s3_obj, bucket_name, prefix, substring=None):
+    '''Like s3_list_files, but return the metadata of each object so that keys
+    can be compared against the load manifest.
+    RETURNS:
+    objects (list of dicts): 'Key', 'ETag', 'Size' and 'LastModified' of each object
+    '''
+    with stage_timer('list', key=None, prefix=None) as stage:
+        objects = [obj for obj in iter_s3_objects(s3_obj, bucket_name, prefix or '')
+                   if substring is None or substring in obj['Key']]
+        stage['rows'] = len(objects)
+    return objects
 
-    return keys if keys else []
+def list_feed_objects(source, s3prefix, feed_version, start_date=None, end_date=None):
+    '''iter_feed_objects as a list, with the listing time recorded in the metrics.'''
+    with stage_timer('list', key=None, prefix=None) as stage:
+        objects = list(iter_feed_objects(source, s3prefix, feed_version,
+                                         start_date=start_date, end_date=end_date))
+        stage['rows'] = len(objects)
+    return objects
 
-def download_file_from_s3(s3_obj, bucket, key, filename):
+def download_file_from_s3(s3_obj, bucket, key, filename, config=TRANSFER_CONFIG):
     '''Download a single file from an S3 bucket and save it locally.
     INPUTS:
     s3_obj - The instantiated boto3 client object
     bucket (str): The name of the AWS s3 bucket
     key (str): The key (folder structure + file name) to retrieve
     filename (str): The filename to which the key is saved
+    config (TransferConfig): The multipart download settings
     RETURNS: None
     '''
-    s3_obj.download_file(Bucket=bucket, Key=key, Filename=filename)
+    download_feed_file(S3FeedSource(bucket, client=s3_obj, config=config), key, filename)
+
+def download_feed_file(source, key, filename):
+    '''Download a single feed file from a FeedSource and save it locally.'''
+    # Downloads run in the prefetch thread, so they are labelled with their own key only
+    with stage_timer('download', key=key, prefix=None) as stage:
+        source.download(key, filename)
+        stage['bytes'] = os.path.getsize(filename)
+
+def download_to_temp_file(source, key, directory):
+    '''Download a key to a new temporary zip file in directory and return its path.'''
+    fd, filename = tempfile.mkstemp(prefix='athena_', suffix='.zip', dir=directory)
+    os.close(fd)
+    try:
+        download_feed_file(source, key, filename)
+    except Exception:
+        os.remove(filename)
+        raise
+    return filename
+
+def fetch_feed_file(source, key, directory):
+    '''Return (path, temporary) for a key: the file itself if the source can be
+    read in place, otherwise a temporary download that the caller removes.'''
+    path = source.local_path(key)
+    if path is not None:
+        return path, False
+    return download_to_temp_file(source, key, directory), True
+
+def iter_prefetched_downloads(source, keys, directory):
+    '''Download keys one after another, fetching the next key in a background
+    thread while the caller processes the current one.
+    Each key is saved to its own temporary file, which is removed as soon as the
+    caller moves on to the next key.  Keys of a local directory are not copied.
+    INPUTS:
+    source (FeedSource): Where the keys are downloaded from
+    keys (list of strings): The keys to download, in processing order
+    directory (str): Where the temporary zip files are written
+    RETURNS:
+    A generator of (key, filename) tuples
+    '''
+    keys = list(keys)
+    if not keys:
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(fetch_feed_file, source, keys[0], directory)
+        try:
+            for i, key in enumerate(keys):
+                filename, temporary = pending.result()
+                pending = None
+                if i + 1 < len(keys):
+                    pending = executor.submit(fetch_feed_file, source, keys[i + 1], directory)
+                try:
+                    yield key, filename
+                finally:
+                    if temporary:
+                        os.remove(filename)
+        finally:
+            # Don't leave a prefetched file behind if the caller stops early
+            if pending is not None and pending.exception() is None:
+                filename, temporary = pending.result()
+                if temporary:
+                    os.remove(filename)
 
 def delete_local_files(file_to_remove):
     '''Remove a local folder and S3 key after it has been used. Requires import os.
@@ -86,7 +201,7 @@ def delete_local_files(file_to_remove):
     os.remove(file_to_remove)
     print ('Deleted local file: {}'.format(file_to_remove))
 
-def read_csv_from_zip(saved_zip, csvprefix, csv_params={'header': 0, 'skiprows': lambda x: x in [1, 2, 3], 'dtype': {'Deleted Datetime': str}}):
+def read_csv_from_zip(saved_zip, csvprefix, csv_params={'dtype': {'Deleted Datetime': str}}):
     '''Retrieve a single CSV file from a zip file and return a Pandas dataframe.
     Requires import zipfile
     INPUTS:
@@ -96,14 +211,67 @@ def read_csv_from_zip(saved_zip, csvprefix, csv_params={'header': 0, 'skiprows':
     RETURNS:
     df (Pandas dataframe): A Pandas dataframe of the
     '''
-    zip_ref = zipfile.ZipFile(saved_zip, 'r')
-    len_prefix = len(csvprefix)
-    for info in zip_ref.infolist():
-        if csvprefix == info.filename[0:len_prefix]:
-            ext = zip_ref.extract(info.filename)
-            df = pd.read_csv(info.filename, **csv_params)
-            filename = info.filename
-    return filename, df
+    with FeedArchive(saved_zip, [csvprefix]) as archive:
+        return read_csv_from_archive(archive, csvprefix, csv_params=csv_params)
+
+def read_csv_from_archive(archive, csvprefix, csv_params={'dtype': {'Deleted Datetime': str}}):
+    '''Read a single CSV member of an open FeedArchive into a Pandas dataframe,
+    streaming it from the zip rather than extracting it to disk. The header and
+    banner rows are handled by read_athena_csv, so csv_params should not set
+    header or skiprows.
+    RETURNS:
+    filename (str): The name of the zip member
+    df (Pandas dataframe): The contents of the CSV file
+    '''
+    with stage_timer('parse') as stage, archive.open(csvprefix) as member:
+        df = read_athena_csv(member, **csv_params)
+        stage['rows'], stage['bytes'] = len(df), archive.file_size(csvprefix)
+    return archive.filename(csvprefix), df
+
+# Rough number of copies of a chunk alive at once while it is transformed and
+# serialised for COPY (the parsed chunk, its transformed copy and the COPY text)
+CHUNK_MEMORY_FACTOR = 3
+
+def iter_bounded_chunks(reader, chunksize, memory_limit=None):
+    '''Yield chunks from a pandas TextFileReader, shrinking or growing the number
+    of rows per chunk so that a chunk and its copies stay within memory_limit.
+    The first chunk has chunksize rows; later sizes are estimated from the
+    measured memory per row of the previous chunk.
+    INPUTS:
+    reader (TextFileReader): The result of pd.read_csv(..., iterator=True)
+    chunksize (int): The number of rows in the first chunk
+    memory_limit (int or None): The memory ceiling in bytes, or None for fixed size chunks
+    RETURNS:
+    A generator of Pandas dataframes
+    '''
+    size = chunksize
+    with reader:
+        while True:
+            try:
+                df = reader.get_chunk(size)
+            except StopIteration:
+                return
+            if memory_limit and len(df):
+                bytes_per_row = df.memory_usage(deep=True).sum() / len(df)
+                size = max(1000, int(memory_limit / (bytes_per_row * CHUNK_MEMORY_FACTOR)))
+            yield df
+
+def read_csv_chunks_from_archive(archive, csvprefix, csv_params={'dtype': {'Deleted Datetime': str}, 'chunksize': 100000}, memory_limit=None):
+    '''Read a single CSV member of an open FeedArchive in chunks, so that only one
+    chunk is held in memory at a time.
+    INPUTS:
+    archive (FeedArchive): The open feed zip
+    csvprefix (str): The file prefix to retrieve
+    csv_params (dict): The Pandas kwargs used to read the CSV file, including 'chunksize'
+    memory_limit (int or None): Memory ceiling in bytes used to size the chunks
+    RETURNS:
+    filename (str): The name of the zip member
+    chunks (iterator): An iterator of Pandas dataframes
+    '''
+    csv_params = dict(csv_params)
+    chunksize = csv_params.pop('chunksize')
+    reader = read_athena_csv(archive.open(csvprefix), iterator=True, **csv_params)
+    return archive.filename(csvprefix), iter_bounded_chunks(reader, chunksize, memory_limit)
 
 def date_func(x):
     try:
@@ -117,40 +285,196 @@ def datetime_func(x):
     except:
         return pd.NaT
 
-def reformat_datetimes(df):
+# Character positions that rearrange Athena's fixed width MM/DD/YYYY dates into
+# ISO order, keyed by (input format, output format)
+ATHENA_TO_ISO = {
+    ('%m/%d/%Y', '%Y-%m-%d'): [6, 7, 8, 9, 2, 0, 1, 5, 3, 4],
+    ('%m/%d/%Y %H:%M:%S', '%Y-%m-%d %H:%M:%S'): [6, 7, 8, 9, 2, 0, 1, 5, 3, 4] + list(range(10, 19)),
+}
+
+def rearrange_fixed_width(strings, order):
+    '''Reorder the characters of equal length strings as a numpy character matrix,
+    e.g. '11/04/2018' -> '2018-11-04'. The separators at ISO positions 4 and 7 are
+    set to '-'. Also returns a mask of the strings whose original separators were '/'.'''
+    width = len(order)
+    chars = np.asarray(strings, dtype='U{}'.format(width)).view('U1').reshape(len(strings), width)
+    slashes = (chars[:, order[4]] == '/') & (chars[:, order[7]] == '/')
+    iso = chars[:, order]
+    iso[:, 4] = '-'
+    iso[:, 7] = '-'
+    return np.ascontiguousarray(iso).view('U{}'.format(width)).ravel(), slashes
+
+def convert_date_strings(series, in_format, out_format):
+    '''Vectorized replacement for applying date_func/datetime_func to a column.
+    Each distinct string is converted only once and the results are mapped back
+    onto the rows, so repeated dates cost nothing extra. Athena's fixed width
+    layouts are rearranged into ISO strings and validated with pandas' fast ISO
+    parser; anything else falls back to pd.to_datetime with in_format.
+    Values that are not valid dates become missing, as with date_func.
+    INPUTS:
+    series (Pandas series): A column of date strings
+    in_format (str): The strptime format of the strings, e.g. '%m/%d/%Y'
+    out_format (str): The strftime format of the result, e.g. '%Y-%m-%d'
+    RETURNS:
+    Pandas series of reformatted strings
+    '''
+    codes, uniques = pd.factorize(series)
+    uniques = np.asarray(uniques, dtype=object)
+    # One extra slot so that missing values (code -1) take the trailing NaN
+    formatted = np.full(len(uniques) + 1, np.nan, dtype=object)
+    rest = np.ones(len(uniques), dtype=bool)
+    order = ATHENA_TO_ISO.get((in_format, out_format))
+    if order is not None and len(uniques):
+        fixed = pd.Series(uniques).str.len().to_numpy() == len(order)
+        if fixed.any():
+            iso, slashes = rearrange_fixed_width(uniques[fixed], order)
+            valid = slashes & pd.to_datetime(iso, format=out_format, errors='coerce').notna()
+            formatted[np.flatnonzero(fixed)[valid]] = iso[valid]
+            rest = ~fixed
+    if rest.any():
+        parsed = pd.to_datetime(pd.Series(uniques[rest], dtype=object), format=in_format, errors='coerce')
+        formatted[np.flatnonzero(rest)] = parsed.dt.strftime(out_format).to_numpy(dtype=object)
+    return pd.Series(formatted.take(codes), index=series.index, name=series.name)
+
+def reformat_datetimes(df, date_formats=None):
     '''Reformat dates and datetimes to 'yyyy-mm-dd 00:00:00.
-    If column is date, then format to YYYY-MM-DD.'''
-    date_columns = [col for col in df.columns if col[-4:] == 'Date' and not df[col].isnull().all()]
-    datetime_columns = [col for col in df.columns if col[-8:] == 'Datetime' and not df[col].isnull().all()]
-    for dc in date_columns:
-        df[dc] = df[dc].apply(date_func)
-        #df[dc].fillna('1985-07-03', inplace=True)
-    for dtc in datetime_columns:
-        df[dtc] = df[dtc].apply(datetime_func)
-        #df[dtc].fillna('1985-07-03 12:12:12', inplace=True)
+    If column is date, then format to YYYY-MM-DD.
+    date_formats (dict or None): (input format, output format) by column, from a
+    LoadPlan. If None, the columns are found by name.'''
+    if date_formats is None:
+        date_formats = find_date_formats(df.columns)
+    for col, (in_format, out_format) in date_formats.items():
+        if not df[col].isnull().all():
+            df[col] = convert_date_strings(df[col], in_format, out_format)
     return df
 
-def replace_missing_ids(df):
-    id_columns = [col for col in df.columns if col[-2:] == 'ID' and not df[col].isnull().all()]
+def replace_missing_ids(df, id_columns=None):
+    '''ID columns are read as pandas' nullable Int64 (see athena_file_dict), so
+    missing IDs stay missing and are loaded as NULL. Any ID column that was still
+    read as a float is converted the same way, without filling in a sentinel.
+    id_columns (list or None): The ID columns from a LoadPlan. If None, they are found by name.'''
+    if id_columns is None:
+        id_columns = find_id_columns(df.columns)
     for idc in id_columns:
-        df[idc].fillna(0, inplace=True)
-        df[idc] = df[idc].astype('int')
+        if df[idc].dtype.kind == 'f':
+            df[idc] = df[idc].astype('Int64')
     return df
 
 def replace_missing_ints(df, intlist):
     '''Integer columns with too many missing values can't be read in using pd.read_csv().
-    Instead, read them as a float, replace missing values with 0 and cast as an integer.
+    Instead, read them as a float and cast them to the nullable Int64 dtype, so
+    missing values are loaded as NULL. Fractions are truncated as before.
     '''
-    int_columns = [col for col in df.columns if col in intlist and not df[col].isnull().all()]
+    int_columns = [col for col in df.columns if col in intlist and df[col].dtype.kind == 'f']
     for idc in int_columns:
-        df[idc].fillna(0, inplace=True)
-        df[idc] = df[idc].astype('int')
+        df[idc] = np.trunc(df[idc]).astype('Int64')
     return df
 
-def write_formatted_csv(df, filename):
-    ''' Write out a CSV with dates formatted correctly'''
+# Embedded line breaks in free text are loaded as a space
+NEWLINES_TO_SPACE = str.maketrans('\r\n', '  ')
+
+def sanitize_text_columns(df, text_columns):
+    '''Replace embedded newlines and carriage returns in the free text columns with
+    a space. Only the values that contain one are rewritten, so the cost scales
+    with the amount of multi-line text rather than with the width of the table.
+    INPUTS:
+    df (Pandas dataframe): The data to load
+    text_columns (list of strings): The string columns, e.g. LoadPlan.text_columns
+    RETURNS:
+    df (Pandas dataframe)
+    '''
+    for col in text_columns:
+        values = df[col]
+        multiline = values.str.contains('[\r\n]', regex=True, na=False)
+        if multiline.any():
+            df.loc[multiline, col] = values[multiline].str.translate(NEWLINES_TO_SPACE)
+    return df
+
+def to_copy_text(df, header=False):
+    '''Encode a dataframe as PostgreSQL COPY text format: tab delimited, an empty
+    field for NULL, and tabs, backslashes and quotes backslash escaped by the csv
+    writer in the same pass that formats the rows. Line breaks must already have
+    been removed with sanitize_text_columns.'''
+    return df.to_csv(sep='\t', date_format='%Y-%m-%d %H:%M:%S', index=False, header=header,
+                     quoting=csv.QUOTE_NONE, escapechar='\\', doublequote=False)
+
+def write_formatted_csv(df, filename, text_columns=()):
+    ''' Write out a CSV with dates formatted correctly, in COPY text format'''
     ''' Returns none '''
-    df.to_csv(filename, sep='\t', date_format='%Y-%m-%d %H:%M:%S', index=False)
+    with stage_timer('write_csv') as stage, open(filename, 'w') as f:
+        df = sanitize_text_columns(df, text_columns)
+        stage['rows'] = len(df)
+        stage['bytes'] = f.write(to_copy_text(df, header=True))
+
+class ChunkedCSVStream(object):
+    '''File-like adapter that serialises an iterator of dataframes as tab separated
+    COPY text on demand, so it can be passed straight to cursor.copy_expert.
+    Newlines in text_columns are sanitised as each chunk is encoded.
+    Only one chunk is held in memory at a time.'''
+
+    def __init__(self, chunks, transform=None, text_columns=()):
+        self.chunks = iter(chunks)
+        self.transform = transform
+        self.text_columns = text_columns
+        self.text = ''
+        self.offset = 0
+        self.rows = 0
+        self.bytes = 0
+
+    def _next_chunk(self):
+        while True:
+            with stage_timer('parse') as stage:
+                df = next(self.chunks, None)
+                stage['rows'] = 0 if df is None else len(df)
+            if df is None:
+                return None
+            if self.transform is not None:
+                with stage_timer('transform') as stage:
+                    df = self.transform(df)
+                    stage['rows'] = len(df)
+            if df.empty:
+                continue
+            with stage_timer('encode') as stage:
+                text = to_copy_text(sanitize_text_columns(df, self.text_columns))
+                stage['rows'], stage['bytes'] = len(df), len(text)
+            self.rows += len(df)
+            self.bytes += len(text)
+            return text
+
+    def _fill(self):
+        '''Move on to the next chunk once the current one is used up.
+        RETURNS: False at the end of the stream'''
+        while self.offset >= len(self.text):
+            text = self._next_chunk()
+            if text is None:
+                return False
+            self.text, self.offset = text, 0
+        return True
+
+    def read(self, size=-1):
+        # Slice from an offset into the current chunk rather than re-slicing the
+        # remainder on every call, so each read costs only the bytes it returns
+        parts = []
+        while size != 0 and self._fill():
+            end = len(self.text) if size < 0 else min(len(self.text), self.offset + size)
+            parts.append(self.text[self.offset:end])
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+        return ''.join(parts)
+
+    def readline(self, size=-1):
+        parts = []
+        while size != 0 and self._fill():
+            end = self.text.find('\n', self.offset) + 1 or len(self.text)
+            if size > 0:
+                end = min(end, self.offset + size)
+                size -= end - self.offset
+            parts.append(self.text[self.offset:end])
+            self.offset = end
+            if parts[-1].endswith('\n'):
+                break
+        return ''.join(parts)
 
 def get_warehouse_feed_date(filename,prefix):
     '''Strip the date from the filename and format it as YYYY-MM-DD'''
@@ -160,7 +484,45 @@ def get_warehouse_feed_date(filename,prefix):
     sqldate = dt.datetime.strptime(rawdate, '%Y%m%d').strftime('%Y-%m-%d')
     return sqldate
 
-def load_CSV_to_postgres(dbtable, columns, csvfile, dbhost, dbname, dbuser, dbpw):
+def create_staging_table(cur, dbtable):
+    '''Create an empty temporary copy of dbtable that is dropped at commit.
+    Temporary tables are not WAL logged, so COPY into them runs at full speed.
+    RETURNS:
+    staging_table (str): The name of the staging table
+    '''
+    staging_table = staging_table_name(dbtable)
+    cur.execute(sql.SQL('CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP').format(
+        sql.Identifier(staging_table), table_identifier(dbtable)))
+    return staging_table
+
+def merge_from_staging(cur, dbtable, staging_table, columns, primary_key, overwrite=True):
+    '''Upsert every row of the staging table into dbtable with one statement.
+    If a key appears more than once in the staging table, the row copied last wins.
+    INPUTS:
+    cur: A psycopg2 cursor
+    dbtable (str): The target table
+    staging_table (str): The staging table created by create_staging_table
+    columns (list of strings): The columns that were loaded
+    primary_key (list of strings): The primary key columns of dbtable
+    overwrite (bool): Update rows whose key is already in dbtable; False to only
+    insert new keys, e.g. when the staging table holds an older feed
+    RETURNS: None
+    '''
+    updates = [col for col in columns if col not in primary_key]
+    if updates and overwrite:
+        action = sql.SQL('DO UPDATE SET {}').format(sql.SQL(', ').join(
+            sql.SQL('{0} = excluded.{0}').format(sql.Identifier(col)) for col in updates))
+    else:
+        action = sql.SQL('DO NOTHING')
+    cols = sql.SQL(', ').join(map(sql.Identifier, columns))
+    keys = sql.SQL(', ').join(map(sql.Identifier, primary_key))
+    cur.execute(sql.SQL('''INSERT INTO {table} ({cols})
+    SELECT DISTINCT ON ({keys}) {cols} FROM {staging} ORDER BY {keys}, ctid DESC
+    ON CONFLICT ({keys}) {action}''').format(
+        table=table_identifier(dbtable), cols=cols, keys=keys,
+        staging=sql.Identifier(staging_table), action=action))
+
+def load_CSV_to_postgres(dbtable, columns, csvfile, dbhost, dbname, dbuser, dbpw, primary_key=None, replace=False):
     '''Load the CSV data to a table in PostgreSQL database.
     Requires import psycopg2 and from pgcopy import CopyManager, Replace.
     Uses a psycopg2 database connection and pgcopy for fast bulk inserts.
@@ -170,17 +532,101 @@ def load_CSV_to_postgres(dbtable, columns, csvfile, dbhost, dbname, dbuser, dbpw
     dbtable (str): The table in which to insert values.
     db<credential>: The Postgres login, database and schema credentials.
     columns (tuple of strings): A tuple containing the PostgreSQL table names to insert.
+    primary_key (list of strings or None): If given, upsert on these columns
+    through a staging table instead of appending.
+    replace (bool): Full refresh: load a new copy of the table and swap it in.
     RETURNS: None
     '''
-    conn = psycopg2.connect(host=dbhost,
-                            dbname=dbname,
-                            user=dbuser,
-                            password=dbpw)
-    cur = conn.cursor()
-    with open(csvfile, 'r') as f:
-        next(f)  # Skip the header row.
-        cur.copy_from(f, dbtable, sep='\t', null='', columns=columns)
-    conn.commit()
+    with pg_connection(dbhost, dbname, dbuser, dbpw) as conn:
+        with conn.cursor() as cur, open(csvfile, 'r') as f:
+            set_bulk_load_settings(cur)
+            if replace:
+                target = create_swap_table(cur, dbtable)
+            else:
+                target = create_staging_table(cur, dbtable) if primary_key else dbtable
+            next(f)  # Skip the header row.
+            with copy_timer(), stage_timer('copy') as stage:
+                # copy_from would quote a schema qualified name as a single identifier
+                cur.copy_expert(copy_statement(target, columns), f)
+                stage['rows'], stage['bytes'] = cur.rowcount, os.path.getsize(csvfile)
+            if replace:
+                swap_in_table(cur, dbtable, target)
+            elif primary_key:
+                merge_from_staging(cur, dbtable, target, columns, primary_key)
+        conn.commit()
+
+# Session settings for bulk loads, applied with SET LOCAL so they end with the
+# transaction. With synchronous_commit off a crash can lose the last commits,
+# but never corrupt them, and the manifest rows are lost with the loads they
+# describe, so those files are simply loaded again.
+BULK_LOAD_SETTINGS = {'synchronous_commit': 'off',
+                      'work_mem': '256MB',
+                      'maintenance_work_mem': '1GB'}
+
+def set_bulk_load_settings(cur, settings=BULK_LOAD_SETTINGS):
+    '''SET LOCAL every bulk load setting for the rest of the current transaction.'''
+    for name, value in settings.items():
+        cur.execute('SELECT set_config(%s, %s, true)', (name, value))
+
+def copy_stream(cur, dbtable, columns, stream, manifest=None, primary_key=None, copy_sql=None, replace=False):
+    '''COPY a stream into a table within the caller's transaction; the
+    arguments are as for load_stream_to_postgres.
+    When a newer feed of the prefix is already in the manifest, a full refresh is
+    skipped (and recorded with no rows) and an upsert only inserts keys that are
+    missing, so loading an older feed never replaces newer rows with older ones.
+    RETURNS:
+    rows (int): The number of rows copied
+    '''
+    stale = (replace or primary_key) and manifest is not None and newer_feed_loaded(cur, manifest)
+    if replace and stale:
+        print('Skipping {} of {}: a newer feed is already loaded'.format(manifest['prefix'], manifest['key']))
+        insert_manifest_row(cur, manifest, 0)
+        return 0
+    if replace:
+        target = create_swap_table(cur, dbtable)
+    elif primary_key:
+        target = create_staging_table(cur, dbtable)
+    else:
+        target = dbtable
+    if copy_sql is None:
+        copy_sql = copy_statement(target, columns)
+    with copy_timer():
+        cur.copy_expert(copy_sql, stream)
+    rows = getattr(stream, 'rows', cur.rowcount)
+    if replace:
+        with stage_timer('swap') as stage:
+            swap_in_table(cur, dbtable, target)
+            stage['rows'] = rows
+    elif primary_key:
+        merge_from_staging(cur, dbtable, target, columns, primary_key, overwrite=not stale)
+    if manifest is not None:
+        insert_manifest_row(cur, manifest, rows)
+    return rows
+
+def load_stream_to_postgres(dbtable, columns, stream, dbhost, dbname, dbuser, dbpw, manifest=None, primary_key=None, copy_sql=None,
+                            replace=False):
+    '''Load tab separated COPY text from a file-like object to a table in PostgreSQL
+    using COPY FROM STDIN, without writing an intermediate file.
+    INPUTS:
+    dbtable (str): The table in which to insert values.
+    columns (list of strings): The PostgreSQL table columns to insert.
+    stream (file-like): An object with a read() method, e.g. a ChunkedCSVStream.
+    db<credential>: The Postgres login, database and schema credentials.
+    manifest (dict or None): If given, the load is recorded in the load manifest
+    in the same transaction (see athena_load_manifest).
+    primary_key (list of strings or None): If given, upsert on these columns
+    through a staging table instead of appending.
+    copy_sql (sql.Composed or None): The precompiled COPY statement of a LoadPlan.
+    replace (bool): Full refresh: COPY into a new unindexed table, then index,
+    analyze and swap it in for dbtable (see pg_table_swap).
+    RETURNS: None
+    '''
+    with pg_connection(dbhost, dbname, dbuser, dbpw) as conn:
+        with conn.cursor() as cur:
+            set_bulk_load_settings(cur)
+            copy_stream(cur, dbtable, columns, stream, manifest=manifest, primary_key=primary_key, copy_sql=copy_sql,
+                        replace=replace)
+        conn.commit()
 
 def delete_duplicates_from_pg_table(table, id):
     ''' Eventually we will use this to delete duplicate rows from a table after
@@ -191,30 +637,314 @@ def delete_duplicates_from_pg_table(table, id):
     AND a.feed_date < b.feed_date"""
 
 
-def setup_parameters(file_dict, prefix):
-    ''' Set up the parameters for the files to load from S3'''
-    d = file_dict[prefix]['columns']
-    r = file_dict[prefix]['rename']
-    # Postgres table information
-    postgres_table = file_dict[prefix]['postgres_table']
-    # Create the list of columns by lowercasing and replacing spaces with '_'
-    #columns = [k.replace(' ','_').lower() for k in d.keys()]
-    csv_columns = [k for k in d.keys()]
-    # Get a list of character variables, excluding any that are not datetime
-    # DEPRECATED USING psycopg2 copy_from
-    charvars = [k for k, v in d.items() if v == str and 'Datetime' not in k]
-    # kwargs used to read the csv file
-    csv_args = {'header': 0, 'skiprows': lambda x: x in [1, 2, 3], 'dtype': d}
-    # Create a list of the PostgreSQL table columns to load.
-    # Convert Camel case with spaces to snake case and rename columns as needed
-    if r:
-        pgcols = [r[key] if key in r.keys() else key.replace(' ', '_').lower() for key in d.keys()]
-    else:
-        pgcols = [k.replace(' ','_').lower() for k in d.keys()]
+def setup_parameters(file_dict, prefix, chunksize=None):
+    ''' Set up the parameters for the files to load from S3.
+    If chunksize is given, the csv file is read chunksize rows at a time.
+    The loader itself uses compiled LoadPlans (see athena_load_plan).'''
+    plan = LoadPlan(file_dict, prefix, chunksize=chunksize)
+    csv_args = plan.chunked_csv_args() if chunksize else plan.csv_args
+    return plan.csv_columns, csv_args, plan.charvars, plan.postgres_table, plan.pgcols
 
-    if prefix == 'provider_':
-        pgcols.append('feed_date')
-    return csv_columns, csv_args, charvars, postgres_table, pgcols
+def transform_dataframe(df, plan, feed_date):
+    '''Apply the cleanup steps required before loading an Athena dataframe.
+    Used on whole files and on individual chunks alike.
+    plan (LoadPlan): The compiled plan of the file's prefix'''
+    df = df[plan.csv_columns]
+    if plan.add_feed_date:
+        df = df.assign(feed_date=feed_date)
+    # Re-format the date columns
+    with stage_timer('dates') as stage:
+        df = reformat_datetimes(df, plan.date_formats)
+        stage['rows'] = len(df)
+    # Store ID's and integers as nullable integers
+    df = replace_missing_ids(df, plan.id_columns)
+    df = replace_missing_ints(df, plan.int_columns)
+    return df
+
+def open_prefix_stream(archive, plan, feed_version, memory_limit=None):
+    '''Set up the chunked parse, transform and encode pipeline of one CSV member of
+    an open FeedArchive. Nothing is parsed until the stream is read.
+    With the 'arrow' backend the whole member is parsed and cleaned by pyarrow
+    here, and only the Pandas conversion and encoding happen chunk by chunk.
+    Raises KeyError if the prefix is not in the zip.
+    RETURNS:
+    stream (ChunkedCSVStream): COPY text of the member, with .rows and .bytes counts
+    '''
+    filename = archive.filename(plan.prefix)
+    feed_date = get_warehouse_feed_date(filename, feed_version)
+    # Rows are counted as the chunks are parsed; the bytes are the uncompressed member size
+    with stage_timer('parse') as stage:
+        stage['bytes'] = archive.file_size(plan.prefix)
+        if plan.backend == 'arrow':
+            with archive.open(plan.prefix) as member:
+                chunks = read_arrow_chunks(member, plan)
+            transform = lambda df: df.assign(feed_date=feed_date) if plan.add_feed_date else df
+        else:
+            filename, chunks = read_csv_chunks_from_archive(archive, plan.prefix, csv_params=plan.chunked_csv_args(),
+                                                            memory_limit=memory_limit)
+            transform = lambda df: transform_dataframe(df, plan, feed_date)
+    return ChunkedCSVStream(chunks, transform=transform, text_columns=plan.text_columns)
+
+def stream_archive_to_postgres(archive, plan, feed_version, dbhost, dbname, dbuser, dbpw, manifest=None, memory_limit=None):
+    '''Stream one CSV member of an open FeedArchive into PostgreSQL chunk by chunk.
+    The member is never extracted and no intermediate CSV is written, so memory
+    use is bounded by chunksize (or memory_limit, in bytes) rather than by the
+    size of the file. Every transform runs on one chunk at a time.
+    Raises KeyError if the prefix is not in the zip.
+    INPUTS:
+    plan (LoadPlan): The compiled plan of the prefix to load
+    RETURNS:
+    rows (int): The number of rows sent to PostgreSQL
+    '''
+    with metrics_context(prefix=plan.prefix):
+        stream = open_prefix_stream(archive, plan, feed_version, memory_limit=memory_limit)
+        with stage_timer('copy') as stage:
+            load_stream_to_postgres(plan.dbtable, plan.pgcols, stream, dbhost=dbhost, dbname=dbname, dbuser=dbuser, dbpw=dbpw,
+                                    manifest=manifest, primary_key=plan.primary_key, copy_sql=plan.copy_sql,
+                                    replace=plan.load_mode == 'replace')
+            stage['rows'], stage['bytes'] = stream.rows, stream.bytes
+    return stream.rows
+
+# The FeedArchive opened by each worker process of load_zip_parallel
+_worker_archive = None
+
+def init_archive_worker(saved_zip, prefixes):
+    '''Process pool initializer: open the feed zip once per worker process.'''
+    global _worker_archive
+    _worker_archive = FeedArchive(saved_zip, prefixes)
+
+def load_prefix_worker(plan, feed_version, dbhost, dbname, dbuser, dbpw, manifest=None, memory_limit=None):
+    '''Process pool entry point: stream one prefix of the worker's feed zip into
+    PostgreSQL. Each worker has its own database connection, so the number of
+    concurrent connections never exceeds the number of workers.
+    RETURNS:
+    prefix (str), dbtable (str), rows (int),
+    metrics (list of dicts): The stage metrics of this prefix, for merge_stage_metrics
+    '''
+    rows = stream_archive_to_postgres(_worker_archive, plan, feed_version,
+                                      dbhost=dbhost, dbname=dbname, dbuser=dbuser, dbpw=dbpw, manifest=manifest,
+                                      memory_limit=memory_limit)
+    return plan.prefix, plan.dbtable, rows, drain_stage_metrics()
+
+def order_prefixes_by_size(archive, prefixes):
+    '''Order prefixes by the uncompressed size of their zip member, largest first,
+    so the longest running table is started before the small ones.'''
+    return sorted(prefixes, key=archive.file_size, reverse=True)
+
+def load_zip_parallel(saved_zip, prefixes, plans, feed_version, max_workers, dbhost, dbname, dbuser, dbpw, manifest=None, memory_limit=None):
+    '''Load all prefixes of one feed zip concurrently using a pool of worker processes.
+    Parsing is CPU bound pandas work, so processes are used rather than threads.
+    Every worker opens the zip once and reuses it for all the prefixes it loads.
+    A prefix missing from the zip is recorded in the manifest with zero rows.
+    INPUTS:
+    prefixes (list of strings): The prefixes to load
+    plans (dict): LoadPlan by prefix from compile_load_plans, for every known prefix
+    max_workers (int): The number of worker processes, and therefore the maximum
+    number of simultaneous PostgreSQL connections.
+    manifest (dict or None): 'table', 'key' and 'etag' of the zip, if loads
+    should be recorded in the load manifest.
+    memory_limit (int or None): The memory ceiling in bytes for each worker's chunks.
+    RETURNS:
+    results (dict): Rows loaded per postgres table (None if the file was missing)
+    '''
+    results = dict()
+    with FeedArchive(saved_zip, plans.keys()) as archive:
+        present = [prefix for prefix in prefixes if prefix in archive]
+        for prefix in prefixes:
+            if prefix not in archive:
+                print ("{} not in zip file".format(prefix))
+                results[plans[prefix].dbtable] = None
+                if manifest is not None:
+                    record_load(dict(manifest, prefix=prefix), 0, dbhost=dbhost, dbname=dbname, dbuser=dbuser, dbpw=dbpw)
+        present = order_prefixes_by_size(archive, present)
+    if not present:
+        return results
+    # Workers are started from a clean server process rather than forked, since the
+    # caller may have other threads (S3 uploads, SFTP transports) holding locks
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('forkserver'),
+                             initializer=init_archive_worker, initargs=(saved_zip, list(plans.keys()))) as executor:
+        futures = []
+        for prefix in present:
+            prefix_manifest = dict(manifest, prefix=prefix) if manifest is not None else None
+            futures.append(executor.submit(load_prefix_worker, plans[prefix], feed_version,
+                                           dbhost, dbname, dbuser, dbpw, prefix_manifest, memory_limit))
+        for future in as_completed(futures):
+            prefix, dbtable, rows, metrics = future.result()
+            merge_stage_metrics(metrics)
+            print("Results updated for {}".format(dbtable))
+            results[dbtable] = rows
+    return results
+
+def load_zip_atomic(saved_zip, prefixes, plans, feed_version, dbhost, dbname, dbuser, dbpw, manifest=None, memory_limit=None):
+    '''Load all prefixes of one feed zip on one connection and commit them together,
+    so either every table gets the feed or none does.  A failure rolls back the
+    whole zip, including its manifest rows, and a rerun loads it from scratch.
+    The prefixes are loaded one after another; see load_zip_parallel for the
+    faster, per prefix alternative.  Full refresh prefixes are loaded last: their
+    swap takes ACCESS EXCLUSIVE locks on the live tables, which are held until
+    the commit and block readers of those tables.
+    INPUTS: As for load_zip_parallel, without max_workers
+    RETURNS:
+    results (dict): Rows loaded per postgres table (None if the file was missing)
+    '''
+    results = dict()
+    with FeedArchive(saved_zip, plans.keys()) as archive, pg_connection(dbhost, dbname, dbuser, dbpw) as conn:
+        with conn.cursor() as cur:
+            set_bulk_load_settings(cur)
+            for prefix in sorted(prefixes, key=lambda prefix: plans[prefix].load_mode == 'replace'):
+                plan = plans[prefix]
+                prefix_manifest = dict(manifest, prefix=prefix) if manifest is not None else None
+                if prefix not in archive:
+                    print ("{} not in zip file".format(prefix))
+                    results[plan.dbtable] = None
+                    if prefix_manifest is not None:
+                        insert_manifest_row(cur, prefix_manifest, 0)
+                    continue
+                with metrics_context(prefix=prefix):
+                    stream = open_prefix_stream(archive, plan, feed_version, memory_limit=memory_limit)
+                    with stage_timer('copy') as stage:
+                        copy_stream(cur, plan.dbtable, plan.pgcols, stream, manifest=prefix_manifest,
+                                    primary_key=plan.primary_key, copy_sql=plan.copy_sql,
+                                    replace=plan.load_mode == 'replace')
+                        stage['rows'], stage['bytes'] = stream.rows, stream.bytes
+                print("Copied {} rows to {}".format(stream.rows, plan.dbtable))
+                results[plan.dbtable] = stream.rows
+        with stage_timer('commit', prefix=None):
+            conn.commit()
+    print("Results committed for {}".format(', '.join(results)))
+    return results
+
+# Dropped index definitions are kept in this table, in the manifest's schema
+DEFERRED_INDEX_TABLE = 'athenadwh_deferred_indexes'
+
+def deferred_index_table(manifest_table):
+    '''The bookkeeping table of dropped indexes, next to the load manifest.'''
+    schema, _, table = manifest_table.rpartition('.')
+    return (schema + '.' if schema else '') + DEFERRED_INDEX_TABLE
+
+def defer_table_indexes(todo, plans, manifest_table, dbhost, dbname, dbuser, dbpw, always=False):
+    '''Drop the secondary indexes of the tables that a backfill adds many rows to.
+    The rows a prefix will add are estimated from its average row count in the
+    load manifest times the number of files to load; tables are chosen with
+    should_defer_indexes unless always is set.  Full refresh tables are skipped,
+    since their indexes are already built after the load.
+    INPUTS:
+    todo (list of tuples): (object, prefixes) from filter_new_files
+    RETURNS:
+    deferred (list of strings): The prefixes whose indexes were dropped
+    '''
+    averages = average_rows_by_prefix(manifest_table, dbhost=dbhost, dbname=dbname, dbuser=dbuser, dbpw=dbpw)
+    index_table = deferred_index_table(manifest_table)
+    deferred = []
+    with pg_connection(dbhost, dbname, dbuser, dbpw) as conn:
+        with conn.cursor() as cur:
+            for prefix in sorted({prefix for obj, remaining in todo for prefix in remaining}):
+                plan = plans[prefix]
+                if plan.load_mode == 'replace':
+                    continue
+                files = sum(1 for obj, remaining in todo if prefix in remaining)
+                expected_rows = averages[prefix] * files if prefix in averages else None
+                if not (always or should_defer_indexes(expected_rows, table_row_estimate(cur, plan.dbtable))):
+                    continue
+                with stage_timer('drop_indexes', key=None, prefix=prefix):
+                    names = drop_secondary_indexes(cur, plan.dbtable, index_table)
+                if names:
+                    print('Deferred {} on {} for ~{} new rows'.format(', '.join(names), plan.dbtable,
+                                                                    int(expected_rows) if expected_rows else 'unknown'))
+                    deferred.append(prefix)
+        conn.commit()
+    return deferred
+
+def rebuild_table_indexes(plans, manifest_table, dbhost, dbname, dbuser, dbpw):
+    '''Rebuild, concurrently, every index in the deferred index table, including
+    any left dropped by an interrupted run. Does nothing if the table does not exist.'''
+    index_table = deferred_index_table(manifest_table)
+    prefixes = {plan.dbtable: prefix for prefix, plan in plans.items()}
+    with pg_connection(dbhost, dbname, dbuser, dbpw) as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT to_regclass(%s)', (index_table,))
+            tables = sorted({row[0] for row in deferred_indexes(cur, index_table)}) if cur.fetchone()[0] else []
+        conn.rollback()
+        for dbtable in tables:
+            start = time.perf_counter()
+            with stage_timer('build_indexes', key=None, prefix=prefixes.get(dbtable)):
+                names = rebuild_deferred_indexes(conn, index_table, dbtable)
+            print('Rebuilt {} on {} in {:.1f}s'.format(', '.join(names), dbtable, time.perf_counter() - start))
+
+def order_feed_objects(objects, feed_version):
+    '''Sort feed zips by feed date, oldest first, so a backfill loads days in order.'''
+    return sorted(objects, key=lambda obj: (get_warehouse_feed_date(obj['Key'], feed_version), obj['Key']))
+
+def load_new_feed_files(source, objects, prefixes, plans, feed_version, location, max_workers, manifest_table,
+                        dbhost, dbname, dbuser, dbpw, memory_limit=None, atomic=False, defer_indexes='never'):
+    '''Load every (feed zip, prefix) that is not yet in the load manifest, oldest
+    feed date first. The manifest row of each prefix is committed with its COPY,
+    so it doubles as a checkpoint: if a run is interrupted, rerunning it skips
+    everything that was committed and resumes with the first missing prefix.
+    The next zip is downloaded while the current one is loaded by max_workers
+    processes, so at most two zips are on disk at a time.
+    INPUTS:
+    source (FeedSource): Where the zips are downloaded from
+    objects (list of dicts): Feed zip metadata from iter_feed_objects
+    prefixes (list of strings): The prefixes to load
+    plans (dict): LoadPlan by prefix from compile_load_plans
+    location (str): Where the zips are downloaded to
+    manifest_table (str): schema.table of the load manifest
+    atomic (bool): Load each zip in one transaction with load_zip_atomic
+    defer_indexes (str): 'auto' to drop the secondary indexes of tables that get
+    many new rows (see defer_table_indexes) and rebuild them after the last zip,
+    'always' to do so for every table, or 'never'
+    RETURNS:
+    todo (list of tuples): The (object, prefixes) that were loaded
+    '''
+    loaded = get_load_manifest(manifest_table, dbhost=dbhost, dbname=dbname, dbuser=dbuser, dbpw=dbpw)
+    todo = filter_new_files(order_feed_objects(objects, feed_version), loaded, prefixes)
+    print('{} of {} feed files need loading'.format(len(todo), len(objects)))
+    creds = {'dbhost': dbhost, 'dbname': dbname, 'dbuser': dbuser, 'dbpw': dbpw}
+    if defer_indexes == 'never':
+        # Indexes left dropped by an interrupted backfill are rebuilt before loading
+        rebuild_table_indexes(plans, manifest_table, **creds)
+    elif todo:
+        defer_table_indexes(todo, plans, manifest_table, always=defer_indexes == 'always', **creds)
+    try:
+        downloads = iter_prefetched_downloads(source, [obj['Key'] for obj, remaining in todo], location)
+        for (obj, remaining), (key, zip_path) in zip(todo, downloads):
+            print('processing key: {}'.format(key))
+            manifest = {'table': manifest_table, 'key': key, 'etag': obj['ETag']}
+            with metrics_context(key=key):
+                if atomic:
+                    load_zip_atomic(zip_path, remaining, plans, feed_version, manifest=manifest,
+                                    memory_limit=memory_limit, **creds)
+                else:
+                    load_zip_parallel(zip_path, remaining, plans, feed_version, max_workers, manifest=manifest,
+                                      memory_limit=memory_limit, **creds)
+    finally:
+        if defer_indexes != 'never':
+            rebuild_table_indexes(plans, manifest_table, **creds)
+    return todo
+
+def load_feed_file(zip_path, key, etag, prefixes, plans, feed_version, max_workers, manifest_table,
+                   dbhost, dbname, dbuser, dbpw, memory_limit=None):
+    '''Load a feed zip that is already on local disk, recording it in the load
+    manifest under its S3 key and ETag so that the S3 path skips it later.
+    INPUTS:
+    zip_path (str): The local copy of the zip
+    key (str), etag (str): The S3 key and ETag the zip is (or will be) archived under
+    prefixes (list of strings): The prefixes to load; those already in the manifest are skipped
+    RETURNS:
+    results (dict): Rows loaded by table
+    '''
+    loaded = get_load_manifest(manifest_table, dbhost=dbhost, dbname=dbname, dbuser=dbuser, dbpw=dbpw)
+    remaining = pending_prefixes(loaded, key, etag, prefixes)
+    if not remaining:
+        print('{} is already loaded'.format(key))
+        return dict()
+    print('processing key: {}'.format(key))
+    manifest = {'table': manifest_table, 'key': key, 'etag': etag}
+    with metrics_context(key=key):
+        return load_zip_parallel(zip_path, remaining, plans, feed_version, max_workers,
+                                 dbhost=dbhost, dbname=dbname, dbuser=dbuser, dbpw=dbpw, manifest=manifest,
+                                 memory_limit=memory_limit)
 
 if __name__ == '__main__':
     # Postgres credentials
@@ -224,69 +954,112 @@ if __name__ == '__main__':
     prod_user = 'bi_user'
     prod_pw = '01f!uVk8cm%*'
 
-    intlist=['Dosage Quantity', 'Prescription Fill Quantity','Number of Refills Prescribed']
+    intlist = INT_COLUMNS
     feed_version = '_17.3_'
-    #Instantiate boto3 S3 client
-    s3 = boto3.client('s3')
 
-    saved_zip = 'athena.zip'
+    # Stream zip members straight into COPY instead of extracting them
+    streaming = True
+    chunksize = 100000
+    # Memory ceiling for the chunks of each worker, in MB (None for fixed size chunks)
+    memory_limit_mb = 512
+    memory_limit = memory_limit_mb * 1024 * 1024 if memory_limit_mb else None
+    # Number of prefixes loaded at once (one process and one connection each)
+    max_workers = 4
+    # CSV parser: 'pandas', or 'arrow' to parse each file on all cores with pyarrow
+    # (use fewer workers with 'arrow', since every worker already uses every core)
+    parse_backend = 'pandas'
+    # Skip feed files already recorded in the load manifest (requires streaming)
+    incremental = True
+    # Feed dates the incremental run looks back over, so a missed night is picked up
+    # without reloading the whole bucket (older dates: backfill_athena_feeds.py)
+    lookback_days = 3
+    # Load each zip in a single transaction: all of its tables or none (ignores max_workers)
+    atomic = False
+    # Drop secondary indexes while loading and rebuild them afterwards: 'never', 'auto'
+    # (for tables that get many rows compared with their size) or 'always'
+    defer_indexes = 'never'
+    manifest_table = 'looker_scratch.athenadwh_load_manifest'
+
     saved_csv = 'fixed_file.csv'
     #location = '/Users/danedstrom/Documents/bi_projects/import_athena_files/'
     # CHANGE FILE LOCATION WHEN MOVING TO UBUNTU
     location = '/home/ubuntu/'
-    zip_loc = location + saved_zip
     csv_loc = location + saved_csv
+    # Per-stage timings of the run, and optionally a node_exporter textfile
+    metrics_json = location + 'athena_etl_metrics.json'
+    prometheus_textfile = None  # e.g. '/var/lib/node_exporter/textfile_collector/athena_etl.prom'
 
-    substring = feed_version + dt.datetime.today().strftime('%Y%m%d')
-    #substring='17.3_20181020'
-    #substring = (dt.datetime.today() - datetime.timedelta(days=1)).strftime('%Y%m%d')
-    #start_date = '20181105'
-    #num_days = 8
-    #dates = [(dt.datetime.strptime(start_date, '%Y%m%d') + timedelta(n)).strftime('%Y%m%d') for n in range(num_days)]
+    # To load a range of feed dates, use backfill_athena_feeds.py
+    today = dt.datetime.today().strftime('%Y%m%d')
+    lookback_start = (dt.datetime.today() - dt.timedelta(days=lookback_days)).strftime('%Y%m%d')
 
-    # Get JSON file of Athena columns
+    # Get JSON file of Athena columns and compile the load plans once for every key
     file_dict = athena_file_dict.get_dictionary()
+    plans = compile_load_plans(file_dict, prod_schema, intlist, chunksize=chunksize, backend=parse_backend)
 
-    # AWS S3 information
+    # AWS S3 information. feed_location can also be a local directory laid out
+    # like the bucket, and feed_endpoint an S3-compatible store such as MinIO.
     dhbucket = 'dispatchhealthdata'
     s3prefix='processed/athenaftp/'
+    feed_location = 's3://' + dhbucket
+    feed_endpoint = None
+    source = make_feed_source(feed_location, endpoint_url=feed_endpoint)
     #prefixes = ['medication_', 'patientmedication_']
-    prefixes = ['clinicalprovider_', 'provider_', 'clinicalencounter_', 'document_', 'patientsocialhistory', 'patientpastmedicalhistory',\
-                'medication_', 'patientmedication_']
-
-    # Obtain S3 keys from the S3 bucket
-    # If only getting today's file, using the date as the substring e.g. 20180913
-    keys = s3_list_files(s3, dhbucket, prefix=s3prefix, substring=substring)
+    prefixes = FEED_PREFIXES
 
-    # Get keys for a specific list of dates
-    #keys = [k for k in allkeys for d in dates if d in k]
+    # Load every feed of the last lookback_days that is missing from the manifest
+    if incremental and streaming:
+        objects = list_feed_objects(source, s3prefix, feed_version, start_date=lookback_start, end_date=today)
+        load_new_feed_files(source, objects, prefixes, plans, feed_version, location, max_workers, manifest_table,
+                            dbhost=prod_host, dbname=prod_db, dbuser=prod_user, dbpw=prod_pw, memory_limit=memory_limit,
+                            atomic=atomic, defer_indexes=defer_indexes)
+        # Everything has been loaded through the manifest; skip the per-key loop below
+        keys = []
+    else:
+        # Obtain today's S3 keys from the S3 bucket
+        keys = [obj['Key'] for obj in list_feed_objects(source, s3prefix, feed_version, start_date=today, end_date=today)]
 
-    for key in keys:
-        download_file_from_s3(s3, dhbucket, key, zip_loc)
+    for key, zip_path in iter_prefetched_downloads(source, keys, location):
         print('processing key: {}'.format(key))
-        for prefix in prefixes:
-            csv_columns, csv_args, charvars, postgres_table, pgcols = setup_parameters(file_dict, prefix)
-            postgres_table = prod_schema + '.' + postgres_table
-            df = pd.DataFrame()
-            try:
-                filename, df = read_csv_from_zip(saved_zip, prefix, csv_params=csv_args)
-            except Exception as e:
-                print ("document not in zip file")
-            if not df.empty:
-                feed_date = get_warehouse_feed_date(filename, feed_version)
-                df = df[csv_columns]
-                if prefix == 'provider_':
-                    df['feed_date'] = feed_date
-                # Replace any newline characters with a space
-                df = df.replace('\n',' ', regex=True)
-                # Check for date columns and re-format
-                df = reformat_datetimes(df)
-                # Replace missing ID's w/ zeroes
-                df = replace_missing_ids(df)
-                # Replace missing integers w/ zeroes
-                df = replace_missing_ints(df, intlist)
-                # Write the CSV w/ formatted datetimes
-                write_formatted_csv(df, csv_loc)
-                load_CSV_to_postgres(postgres_table, pgcols, csv_loc, dbhost=prod_host, dbname=prod_db, dbuser=prod_user, dbpw=prod_pw)
-                os.remove(filename)
-            print("Results updated for {}".format(postgres_table))
+        with metrics_context(key=key):
+            if streaming and atomic:
+                load_zip_atomic(zip_path, prefixes, plans, feed_version,
+                                dbhost=prod_host, dbname=prod_db, dbuser=prod_user, dbpw=prod_pw, memory_limit=memory_limit)
+                continue
+            if streaming and max_workers > 1:
+                load_zip_parallel(zip_path, prefixes, plans, feed_version, max_workers,
+                                  dbhost=prod_host, dbname=prod_db, dbuser=prod_user, dbpw=prod_pw, memory_limit=memory_limit)
+                continue
+            archive = FeedArchive(zip_path, plans.keys())
+            for prefix in prefixes:
+                plan = plans[prefix]
+                postgres_table = plan.dbtable
+                if streaming:
+                    try:
+                        stream_archive_to_postgres(archive, plan, feed_version,
+                                                   dbhost=prod_host, dbname=prod_db, dbuser=prod_user, dbpw=prod_pw,
+                                                   memory_limit=memory_limit)
+                    except KeyError:
+                        print ("document not in zip file")
+                    print("Results updated for {}".format(postgres_table))
+                    continue
+                with metrics_context(prefix=prefix):
+                    df = pd.DataFrame()
+                    try:
+                        filename, df = read_csv_from_archive(archive, prefix, csv_params=plan.csv_args)
+                    except Exception as e:
+                        print ("document not in zip file")
+                    if not df.empty:
+                        feed_date = get_warehouse_feed_date(filename, feed_version)
+                        df = transform_dataframe(df, plan, feed_date)
+                        # Write the CSV w/ formatted datetimes
+                        write_formatted_csv(df, csv_loc, plan.text_columns)
+                        load_CSV_to_postgres(postgres_table, plan.pgcols, csv_loc, dbhost=prod_host, dbname=prod_db, dbuser=prod_user, dbpw=prod_pw,
+                                             primary_key=plan.primary_key, replace=plan.load_mode == 'replace')
+                print("Results updated for {}".format(postgres_table))
+            archive.close()
+    print_pool_metrics()
+    print_stage_metrics()
+    write_metrics_json(metrics_json, feed_version=feed_version)
+    if prometheus_textfile:
+        write_prometheus_textfile(prometheus_textfile)
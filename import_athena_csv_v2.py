@@ -6,6 +6,7 @@ import os
 import shutil
 import datetime
 import zipfile
+from pg_connection_pool import pg_connection, copy_timer
 
 '''Basic workflow:
 1. Instantiate s3 client object (assumes aws credentials have been set.
@@ -39,11 +40,7 @@ def get_s3_keys(s3_obj, bucket, prefix=None, substring=None):
     operation_parameters = {'Bucket': bucket,
                             'Prefix': prefix}
     page_iterator = paginator.paginate(**operation_parameters)
-    d = dict()
-    for page in page_iterator:
-        d.update(page)
-
-    key_list = [d['Contents'][k]['Key'] for k in range(len(d['Contents']))]
+    key_list = [obj['Key'] for page in page_iterator for obj in page.get('Contents', [])]
     if substring is not None:
         key_list = [sub for sub in key_list if substring in sub]
     return key_list
@@ -131,13 +128,11 @@ def load_tuples_to_postgres(db_table, columns, data, dbhost, dbname, dbschema, d
     columns (tuple of strings): A tuple containing the PostgreSQL table names to insert.
     RETURNS: None
     '''
-    connection = psycopg2.connect(host=dbhost,
-                                 dbname=dbname,
-                                 user=dbuser,
-                                 password=dbpw)
-    mgr = CopyManager(connection, dbschema + '.' + db_table, columns)
-    mgr.copy(data)
-    connection.commit()
+    with pg_connection(dbhost, dbname, dbuser, dbpw) as connection:
+        mgr = CopyManager(connection, dbschema + '.' + db_table, columns)
+        with copy_timer():
+            mgr.copy(data)
+        connection.commit()
 
 def load_csv_files_to_pg(s3_obj, keys, bucket, s3prefix, s3columns, localzipfile, csv_args, dbtable, dbcolumns, dbhost, dbname, dbschema, dbuser, dbpw):
     """ For a list of keys, read CSV files and load the results to a PostgreSQL
@@ -0,0 +1,213 @@
+import numpy as np
+import pandas as pd
+from psycopg2 import sql
+
+'''Column oriented PGCOPY binary encoder for Pandas dataframes.
+
+Instead of turning a dataframe into a list of Python tuples and letting pgcopy
+encode one value at a time, each column is encoded as a whole from its NumPy
+array: fixed width types are byte swapped in one step and strings are encoded
+in a single call.  The fields are then written into a preallocated buffer at
+offsets computed from the cumulative row sizes: fixed width fields with one
+vectorized assignment per byte position, text values by slice.  Rows are
+encoded in batches as COPY reads them, so memory stays bounded however large
+the dataframe is.  A value that cannot be converted to its column's type raises
+ValueError instead of being loaded as NULL.
+
+Binary COPY requires every value to match the width of the Postgres column
+exactly, so the wire types are read from the table definition in pg_catalog.
+
+Usage:
+    with conn.cursor() as cur:
+        copy_dataframe_binary(cur, 'looker_scratch.athenadwh_document_crosswalk_clone',
+                              df, ['Document ID', 'Patient ID', 'Chart ID'],
+                              ['document_id', 'patient_id', 'chart_id'])
+'''
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + b'\x00\x00\x00\x00' + b'\x00\x00\x00\x00'
+PGCOPY_TRAILER = b'\xff\xff'
+
+# Days between the Unix epoch and the Postgres epoch (2000-01-01)
+PG_EPOCH_DAYS = 10957
+
+FIXED_WIDTH_TYPES = {'int2': '>i2', 'int4': '>i4', 'int8': '>i8', 'float4': '>f4', 'float8': '>f8'}
+TEXT_TYPES = ('varchar', 'text', 'bpchar')
+
+def get_column_types(cur, dbtable, columns):
+    '''Look up the Postgres type name (e.g. 'int4', 'varchar') of each column.
+    INPUTS:
+    cur: A psycopg2 cursor
+    dbtable (str): The schema.table to load
+    columns (list of strings): The Postgres columns to load
+    RETURNS:
+    types (list of strings): The type name of each column, in order
+    '''
+    cur.execute('''SELECT a.attname, t.typname
+    FROM pg_attribute a JOIN pg_type t ON a.atttypid = t.oid
+    WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped''', (dbtable,))
+    table_types = dict(cur.fetchall())
+    return [table_types[col] for col in columns]
+
+def check_converted(series, converted, pg_type):
+    '''Raise ValueError if a value was not missing before conversion but is after,
+    rather than loading it as NULL.'''
+    invalid = converted.isna().to_numpy() & series.notna().to_numpy()
+    if invalid.any():
+        examples = series[invalid].unique()[:5]
+        raise ValueError('Column {} has {} values that are not valid {}: {}'.format(
+            series.name, int(invalid.sum()), pg_type, list(examples)))
+
+def encode_column(series, pg_type):
+    '''Encode one column as PGCOPY field payloads.
+    INPUTS:
+    series (Pandas series): The column to encode
+    pg_type (str): The Postgres type name of the target column
+    RETURNS:
+    lengths (numpy int32 array): The byte length of each value, -1 for NULL
+    payload (numpy uint8 array): The values of all rows, NULLs included
+    value_starts (numpy int64 array): The offset of each row's value in payload
+    '''
+    if pg_type in FIXED_WIDTH_TYPES:
+        wire = np.dtype(FIXED_WIDTH_TYPES[pg_type])
+        values = pd.to_numeric(series, errors='coerce')
+        check_converted(series, values, pg_type)
+        isnull = values.isna().to_numpy()
+        if pg_type.startswith('float'):
+            values = values.to_numpy(dtype='float64', na_value=0.0)
+        else:
+            values = values.to_numpy(dtype='int64', na_value=0)
+        data = values.astype(wire)
+    elif pg_type in ('date', 'timestamp'):
+        values = pd.to_datetime(series, errors='coerce')
+        check_converted(series, values, pg_type)
+        isnull = values.isna().to_numpy()
+        stamps = values.to_numpy(dtype='datetime64[us]')
+        if pg_type == 'date':
+            days = np.where(isnull, 0, stamps.astype('datetime64[D]').astype('int64') - PG_EPOCH_DAYS)
+            data = days.astype('>i4')
+        else:
+            data = np.where(isnull, 0, stamps.astype('int64') - PG_EPOCH_DAYS * 86400 * 1000000).astype('>i8')
+        wire = data.dtype
+    elif pg_type in TEXT_TYPES:
+        isnull = series.isna().to_numpy()
+        # Encode the whole column in one call, separated by NUL (which Postgres
+        # text cannot contain), rather than one str.encode per value
+        text = series.where(~isnull, '').astype(str)
+        payload = np.frombuffer(('\x00'.join(text) + '\x00').encode('utf-8'), dtype='uint8')
+        ends = np.flatnonzero(payload == 0)
+        if len(ends) != len(series):
+            raise ValueError('Text column {} contains NUL characters'.format(series.name))
+        value_starts = np.concatenate(([0], ends[:-1] + 1)).astype('int64')
+        lengths = (ends - value_starts).astype('int32')
+        lengths[isnull] = -1
+        return lengths, payload, value_starts
+    else:
+        raise ValueError('Binary COPY does not support Postgres type {}'.format(pg_type))
+    lengths = np.where(isnull, -1, wire.itemsize).astype('int32')
+    return lengths, data.view('uint8'), np.arange(len(series), dtype='int64') * wire.itemsize
+
+def encode_binary_rows(df, columns, pg_types):
+    '''Encode the rows of a dataframe as PGCOPY binary tuples, without the header
+    and trailer.
+    INPUTS:
+    df (Pandas dataframe): The data to load
+    columns (list of strings): The dataframe columns, in Postgres column order
+    pg_types (list of strings): The Postgres type of each column
+    RETURNS:
+    buffer (numpy uint8 array): One tuple per row
+    '''
+    num_rows = len(df)
+    encoded = [encode_column(df[col], pg_type) for col, pg_type in zip(columns, pg_types)]
+    # Every row is a 2 byte field count, then a 4 byte length and the payload per field
+    row_sizes = np.full(num_rows, 2, dtype='int64')
+    for lengths, payload, value_starts in encoded:
+        row_sizes += 4 + np.maximum(lengths, 0)
+    position = np.cumsum(row_sizes) - row_sizes
+    buffer = np.empty(int(row_sizes.sum()), dtype='uint8')
+
+    def scatter(destinations, values):
+        # One assignment per byte position of a fixed width field, so the index
+        # arrays are one entry per row rather than one per byte
+        for k in range(values.shape[1]):
+            buffer[destinations + k] = values[:, k]
+
+    scatter(position, np.full(num_rows, len(columns), dtype='>i2').view('uint8').reshape(num_rows, 2))
+    position += 2
+    out = memoryview(buffer)
+    for (lengths, payload, value_starts), pg_type in zip(encoded, pg_types):
+        scatter(position, lengths.astype('>i4').view('uint8').reshape(num_rows, 4))
+        position += 4
+        sizes = np.maximum(lengths, 0)
+        if pg_type in TEXT_TYPES:
+            source = memoryview(payload)
+            for dst, src, size in zip(position.tolist(), value_starts.tolist(), sizes.tolist()):
+                out[dst:dst + size] = source[src:src + size]
+        else:
+            valid = lengths >= 0
+            scatter(position[valid], payload.reshape(num_rows, -1)[valid])
+        position += sizes
+    return buffer
+
+# Rows encoded at a time by BinaryCopyStream
+BATCH_ROWS = 50000
+
+class BinaryCopyStream(object):
+    '''File-like reader of a dataframe in PGCOPY binary format.  Rows are encoded
+    BATCH_ROWS at a time as COPY reads them, so only one batch is held in memory.'''
+
+    def __init__(self, df, columns, pg_types, batch_rows=BATCH_ROWS):
+        self.df = df
+        self.columns = columns
+        self.pg_types = pg_types
+        self.batch_rows = batch_rows
+        self.next_row = 0
+        self.finished = False
+        self.buffer = np.frombuffer(PGCOPY_HEADER, dtype='uint8')
+        self.offset = 0
+
+    def _fill(self):
+        '''Move on to the next batch once the current one is used up.
+        RETURNS: False at the end of the stream'''
+        while self.offset >= len(self.buffer):
+            if self.finished:
+                return False
+            if self.next_row < len(self.df):
+                batch = self.df.iloc[self.next_row:self.next_row + self.batch_rows]
+                self.next_row += len(batch)
+                self.buffer = encode_binary_rows(batch, self.columns, self.pg_types)
+            else:
+                self.buffer = np.frombuffer(PGCOPY_TRAILER, dtype='uint8')
+                self.finished = True
+            self.offset = 0
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0 and self._fill():
+            end = len(self.buffer) if size < 0 else min(len(self.buffer), self.offset + size)
+            parts.append(self.buffer[self.offset:end].tobytes())
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+        return b''.join(parts)
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+def copy_dataframe_binary(cur, dbtable, df, columns, pgcols):
+    '''COPY a dataframe into a table using the binary format.
+    INPUTS:
+    cur: A psycopg2 cursor
+    dbtable (str): The schema.table to load
+    df (Pandas dataframe): The data to load
+    columns (list of strings): The dataframe columns to load
+    pgcols (list of strings): The matching Postgres columns
+    RETURNS:
+    rows (int): The number of rows copied
+    '''
+    pg_types = get_column_types(cur, dbtable, pgcols)
+    copy_sql = sql.SQL('COPY {} ({}) FROM STDIN WITH (FORMAT binary)').format(
+        sql.Identifier(*dbtable.split('.')),
+        sql.SQL(', ').join(map(sql.Identifier, pgcols)))
+    cur.copy_expert(copy_sql, BinaryCopyStream(df, columns, pg_types), size=1024 * 1024)
+    return len(df)
@@ -0,0 +1,108 @@
+import os
+import time
+import atexit
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import pool
+
+'''Shared PostgreSQL connection pool used by all of the Athena loaders.
+Connections are opened once per (host, database, user) and reused across
+tables and keys instead of calling psycopg2.connect for every load.
+
+Usage:
+    with pg_connection(dbhost, dbname, dbuser, dbpw) as conn:
+        with copy_timer():
+            cur.copy_expert(...)
+        conn.commit()
+
+The pool size defaults to the PG_POOL_SIZE environment variable (or 4).
+'''
+
+POOL_SIZE = int(os.environ.get('PG_POOL_SIZE', 4))
+
+# Pools keyed by (host, dbname, user).  Each pool remembers the process that
+# created it so a forked worker never reuses its parent's sockets.
+_pools = dict()
+
+pool_metrics = {'checkouts': 0, 'connect_seconds': 0.0,
+                'failed_health_checks': 0, 'copies': 0, 'copy_seconds': 0.0}
+
+def get_pool(dbhost, dbname, dbuser, dbpw, maxconn=None):
+    '''Return the connection pool for a database, creating it on first use.
+    INPUTS:
+    db<credential>: The Postgres login and database credentials.
+    maxconn (int or None): The maximum number of connections; defaults to POOL_SIZE.
+    RETURNS:
+    A psycopg2 ThreadedConnectionPool
+    '''
+    pool_key = (dbhost, dbname, dbuser)
+    pid, conn_pool = _pools.get(pool_key, (None, None))
+    if conn_pool is None or pid != os.getpid():
+        conn_pool = pool.ThreadedConnectionPool(0, maxconn or POOL_SIZE,
+                                                host=dbhost,
+                                                dbname=dbname,
+                                                user=dbuser,
+                                                password=dbpw)
+        _pools[pool_key] = (os.getpid(), conn_pool)
+    return conn_pool
+
+def is_healthy(conn):
+    '''Check that a pooled connection is still usable with a cheap round trip.'''
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+@contextmanager
+def pg_connection(dbhost, dbname, dbuser, dbpw, maxconn=None):
+    '''Check a connection out of the shared pool and always return it.
+    Connections that fail the health check are discarded and replaced.
+    Uncommitted work is rolled back if the block raises.
+    '''
+    conn_pool = get_pool(dbhost, dbname, dbuser, dbpw, maxconn=maxconn)
+    start = time.perf_counter()
+    conn = conn_pool.getconn()
+    if not is_healthy(conn):
+        pool_metrics['failed_health_checks'] += 1
+        conn_pool.putconn(conn, close=True)
+        conn = conn_pool.getconn()
+    pool_metrics['connect_seconds'] += time.perf_counter() - start
+    pool_metrics['checkouts'] += 1
+    try:
+        yield conn
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        conn_pool.putconn(conn, close=bool(conn.closed))
+
+@contextmanager
+def copy_timer():
+    '''Record the time spent copying data, to compare against connect time.'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        pool_metrics['copies'] += 1
+        pool_metrics['copy_seconds'] += time.perf_counter() - start
+
+def print_pool_metrics():
+    '''Print the accumulated connect and copy timings for this process.'''
+    print('connection checkouts: {checkouts}, connect time: {connect_seconds:.2f}s, '
+          'copies: {copies}, copy time: {copy_seconds:.2f}s, '
+          'failed health checks: {failed_health_checks}'.format(**pool_metrics))
+
+def close_all_pools():
+    '''Close every connection in every pool owned by this process.'''
+    for pool_key, (pid, conn_pool) in list(_pools.items()):
+        if pid == os.getpid():
+            conn_pool.closeall()
+        del _pools[pool_key]
+
+atexit.register(close_all_pools)
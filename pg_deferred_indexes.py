@@ -0,0 +1,111 @@
+from psycopg2 import sql
+from pg_table_swap import table_identifier, table_indexes, index_statement
+
+'''Drop secondary indexes before a large bulk load and rebuild them afterwards.
+
+Each COPY into an indexed table updates every index row by row.  For a load
+that is large compared with the table, it is cheaper to drop the secondary
+indexes, load, and build them again in one pass.  Primary keys and unique
+constraints are kept, since upserts and duplicate checks depend on them.
+
+The definition of every dropped index is stored in a bookkeeping table (see
+athenadwh_deferred_indexes in create_tables.sql) in the same transaction as
+the DROP, so an index is never lost: if the load is interrupted, the next run
+rebuilds it.  Indexes are rebuilt with CREATE INDEX CONCURRENTLY, which does
+not block readers or writers of the table, on an autocommit connection.
+
+Usage:
+    with conn.cursor() as cur:
+        if should_defer_indexes(expected_rows, table_row_estimate(cur, dbtable)):
+            drop_secondary_indexes(cur, dbtable, index_table)
+    conn.commit()
+    ... load ...
+    rebuild_deferred_indexes(conn, index_table, dbtable)
+'''
+
+# Defer when a load adds at least DEFER_MIN_ROWS rows and at least
+# DEFER_FRACTION of the rows already in the table
+DEFER_MIN_ROWS = 1000000
+DEFER_FRACTION = 0.2
+
+def should_defer_indexes(expected_rows, table_rows, min_rows=DEFER_MIN_ROWS, fraction=DEFER_FRACTION):
+    '''Decide whether rebuilding a table's indexes after a load is likely to be
+    cheaper than maintaining them during it.
+    INPUTS:
+    expected_rows (int or None): The rows the load is expected to add; None if unknown
+    table_rows (int): The rows already in the table, e.g. from table_row_estimate
+    RETURNS: bool
+    '''
+    if expected_rows is None:
+        return False
+    return expected_rows >= min_rows and expected_rows >= fraction * table_rows
+
+def table_row_estimate(cur, dbtable):
+    '''The planner's estimate of a table's row count (0 if never analyzed).'''
+    cur.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', (dbtable,))
+    return max(int(cur.fetchone()[0]), 0)
+
+def drop_secondary_indexes(cur, dbtable, index_table):
+    '''Record and drop the indexes of a table that do not back a constraint,
+    within the caller's transaction.
+    RETURNS:
+    names (list of strings): The indexes dropped
+    '''
+    schema, _, table = dbtable.rpartition('.')
+    names = []
+    for name, definition in table_indexes(cur, dbtable):
+        cur.execute(sql.SQL('''INSERT INTO {} (table_name, index_name, index_definition, dropped_timestamp)
+        VALUES (%s, %s, %s, now()) ON CONFLICT (table_name, index_name) DO NOTHING''').format(
+            table_identifier(index_table)), (dbtable, name, definition))
+        cur.execute(sql.SQL('DROP INDEX {}').format(table_identifier((schema + '.' if schema else '') + name)))
+        names.append(name)
+    return names
+
+def deferred_indexes(cur, index_table, dbtable=None):
+    '''The dropped indexes waiting to be rebuilt, for one table or all of them.
+    RETURNS:
+    indexes (list of tuples): (table_name, index_name, index_definition)
+    '''
+    query = sql.SQL('SELECT table_name, index_name, index_definition FROM {}').format(table_identifier(index_table))
+    if dbtable is None:
+        cur.execute(query + sql.SQL(' ORDER BY table_name, index_name'))
+    else:
+        cur.execute(query + sql.SQL(' WHERE table_name = %s ORDER BY index_name'), (dbtable,))
+    return cur.fetchall()
+
+def index_state(cur, dbtable, name):
+    '''None if the index does not exist, otherwise whether it is valid. A failed
+    CREATE INDEX CONCURRENTLY leaves an invalid index behind.'''
+    cur.execute('''SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indrelid = %s::regclass AND c.relname = %s''', (dbtable, name))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def rebuild_deferred_indexes(conn, index_table, dbtable):
+    '''Build the dropped indexes of a table with CREATE INDEX CONCURRENTLY and
+    remove them from the bookkeeping table. conn is switched to autocommit for
+    the duration, since concurrent builds cannot run inside a transaction.
+    An index that fails to build stays in the bookkeeping table.
+    RETURNS:
+    names (list of strings): The indexes rebuilt
+    '''
+    schema, _, table = dbtable.rpartition('.')
+    names = []
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for table_name, name, definition in deferred_indexes(cur, index_table, dbtable):
+                state = index_state(cur, dbtable, name)
+                if state is False:
+                    # Left behind by an interrupted concurrent build
+                    cur.execute(sql.SQL('DROP INDEX CONCURRENTLY {}').format(
+                        table_identifier((schema + '.' if schema else '') + name)))
+                if state is not True:
+                    cur.execute(index_statement(definition, name, dbtable, concurrently=True))
+                cur.execute(sql.SQL('DELETE FROM {} WHERE table_name = %s AND index_name = %s').format(
+                    table_identifier(index_table)), (dbtable, name))
+                names.append(name)
+    finally:
+        conn.autocommit = autocommit
+    return names
@@ -0,0 +1,149 @@
+import re
+from psycopg2 import sql
+
+'''Full refresh of a table by loading a new copy and swapping it in.
+
+The new copy is created without indexes, so COPY does not maintain indexes row
+by row.  Once loaded, the live table's primary key, unique constraints and
+indexes are built on it in bulk, it is ANALYZEd, and the tables are swapped by
+renaming them.  Everything runs in the caller's transaction, so readers see
+either the old table or the complete new one.
+
+The copy is an ordinary logged table.  An UNLOGGED copy skips WAL during the
+COPY, but with wal_level replica or logical (as on RDS) the SET LOGGED needed
+before the swap rewrites the table and writes all of it to WAL anyway, so the
+data would be written twice.  With wal_level minimal, a table created in the
+same transaction as the COPY skips WAL on its own.
+
+The swap keeps the live table's column defaults, CHECK constraints, index and
+constraint names, and grants.  Views or foreign keys that depend on the live
+table make the swap fail, since the old table is dropped.
+
+Usage:
+    swap_table = create_swap_table(cur, 'looker_scratch.athenadwh_provider_clone')
+    cur.copy_expert(copy_statement(swap_table, columns), stream)
+    swap_in_table(cur, 'looker_scratch.athenadwh_provider_clone', swap_table)
+    conn.commit()
+'''
+
+# Suffix of the table, indexes and constraints being built
+SWAP_SUFFIX = '_swap'
+
+def table_identifier(dbtable):
+    '''Quote a 'schema.table' or 'table' name for use in psycopg2.sql queries.'''
+    return sql.Identifier(*dbtable.split('.'))
+
+def swap_name(name):
+    '''The name of the copy of a table, index or constraint while it is being built.'''
+    return name[:63 - len(SWAP_SUFFIX)] + SWAP_SUFFIX
+
+def swap_table_name(dbtable):
+    '''The schema qualified name of the new copy of dbtable.'''
+    schema, _, table = dbtable.rpartition('.')
+    return (schema + '.' if schema else '') + swap_name(table)
+
+def create_swap_table(cur, dbtable):
+    '''Create an empty, unindexed copy of dbtable, replacing any copy
+    left behind by an earlier failed load.
+    RETURNS:
+    swap_table (str): The schema qualified name of the copy
+    '''
+    swap_table = swap_table_name(dbtable)
+    cur.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(table_identifier(swap_table)))
+    cur.execute(sql.SQL('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)').format(
+        table_identifier(swap_table), table_identifier(dbtable)))
+    return swap_table
+
+def table_constraints(cur, dbtable):
+    '''The primary key and unique constraints of a table.
+    RETURNS:
+    constraints (list of tuples): (name, definition), e.g. ('t_pkey', 'PRIMARY KEY (id)')
+    '''
+    cur.execute('''SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+    WHERE conrelid = %s::regclass AND contype IN ('p', 'u') ORDER BY contype, conname''', (dbtable,))
+    return cur.fetchall()
+
+def table_indexes(cur, dbtable):
+    '''The indexes of a table that do not belong to a constraint.
+    RETURNS:
+    indexes (list of tuples): (name, definition) with the CREATE INDEX statement
+    '''
+    cur.execute('''SELECT c.relname, pg_get_indexdef(i.indexrelid) FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indrelid = %s::regclass
+      AND NOT EXISTS (SELECT 1 FROM pg_constraint k WHERE k.conindid = i.indexrelid)
+    ORDER BY c.relname''', (dbtable,))
+    return cur.fetchall()
+
+def primary_key_columns(cur, dbtable):
+    '''The primary key columns of a table, or an empty list.'''
+    cur.execute('''SELECT a.attname FROM pg_index i
+    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+    WHERE i.indrelid = %s::regclass AND i.indisprimary
+    ORDER BY array_position(i.indkey, a.attnum)''', (dbtable,))
+    return [row[0] for row in cur.fetchall()]
+
+# CREATE [UNIQUE] INDEX [CONCURRENTLY] name ON [ONLY] table USING ...
+INDEX_DEF = re.compile(r'^CREATE (UNIQUE )?INDEX (?:CONCURRENTLY )?\S+ ON (?:ONLY )?\S+ (USING .*)$')
+
+def index_statement(definition, name, dbtable, concurrently=False):
+    '''Rewrite a pg_get_indexdef statement to build the index under a new name on
+    another table.'''
+    match = INDEX_DEF.match(definition)
+    if match is None:
+        raise ValueError('Cannot parse index definition: {}'.format(definition))
+    unique, rest = match.groups()
+    return sql.SQL('CREATE {}INDEX {}{} ON {} {}').format(
+        sql.SQL(unique or ''), sql.SQL('CONCURRENTLY ' if concurrently else ''), sql.Identifier(name),
+        table_identifier(dbtable), sql.SQL(rest))
+
+def delete_duplicate_keys(cur, dbtable, key_columns):
+    '''Keep only the row copied last for each key, as an upsert would.
+    RETURNS: The number of rows deleted'''
+    match = sql.SQL(' AND ').join(sql.SQL('a.{0} = b.{0}').format(sql.Identifier(col)) for col in key_columns)
+    cur.execute(sql.SQL('DELETE FROM {table} a USING {table} b WHERE {match} AND a.ctid < b.ctid').format(
+        table=table_identifier(dbtable), match=match))
+    return cur.rowcount
+
+def copy_table_grants(cur, dbtable, swap_table):
+    '''Grant on swap_table every privilege that is granted on dbtable.'''
+    cur.execute('''SELECT CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(r.rolname) END, a.privilege_type
+    FROM pg_class c, aclexplode(c.relacl) a
+    LEFT JOIN pg_roles r ON r.oid = a.grantee
+    WHERE c.oid = %s::regclass''', (dbtable,))
+    for grantee, privilege in cur.fetchall():
+        cur.execute(sql.SQL('GRANT {} ON {} TO {}').format(sql.SQL(privilege), table_identifier(swap_table),
+                                                          sql.SQL(grantee)))
+
+def swap_in_table(cur, dbtable, swap_table):
+    '''Index and analyze the loaded copy, and replace dbtable with it.
+    INPUTS:
+    cur: A psycopg2 cursor, in the transaction that created swap_table
+    dbtable (str): The live table
+    swap_table (str): The copy from create_swap_table
+    RETURNS: None
+    '''
+    key_columns = primary_key_columns(cur, dbtable)
+    if key_columns:
+        delete_duplicate_keys(cur, swap_table, key_columns)
+    constraints = table_constraints(cur, dbtable)
+    indexes = table_indexes(cur, dbtable)
+    for name, definition in constraints:
+        cur.execute(sql.SQL('ALTER TABLE {} ADD CONSTRAINT {} {}').format(
+            table_identifier(swap_table), sql.Identifier(swap_name(name)), sql.SQL(definition)))
+    for name, definition in indexes:
+        cur.execute(index_statement(definition, swap_name(name), swap_table))
+    cur.execute(sql.SQL('ANALYZE {}').format(table_identifier(swap_table)))
+    copy_table_grants(cur, dbtable, swap_table)
+    # Swap, then give the new table's constraints and indexes the original names
+    schema, _, table = dbtable.rpartition('.')
+    old_table = table[:63 - len('_old')] + '_old'
+    cur.execute(sql.SQL('ALTER TABLE {} RENAME TO {}').format(table_identifier(dbtable), sql.Identifier(old_table)))
+    cur.execute(sql.SQL('ALTER TABLE {} RENAME TO {}').format(table_identifier(swap_table), sql.Identifier(table)))
+    cur.execute(sql.SQL('DROP TABLE {}').format(table_identifier((schema + '.' if schema else '') + old_table)))
+    for name, definition in constraints:
+        cur.execute(sql.SQL('ALTER TABLE {} RENAME CONSTRAINT {} TO {}').format(
+            table_identifier(dbtable), sql.Identifier(swap_name(name)), sql.Identifier(name)))
+    for name, definition in indexes:
+        swap_index = (schema + '.' if schema else '') + swap_name(name)
+        cur.execute(sql.SQL('ALTER INDEX {} RENAME TO {}').format(table_identifier(swap_index), sql.Identifier(name)))
@@ -0,0 +1,362 @@
+import os
+import time
+import hashlib
+import base64
+import fnmatch
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pysftp
+import boto3
+from athena_etl_metrics import stage_timer, print_stage_metrics
+
+'''Move new Athena feed zips from the SFTP inbound folder to S3.
+
+The inbound folder is polled for datawarehousefeed zips.  A zip is only
+picked up once its size and modification time are unchanged between two
+polls, so files that Athena is still uploading are left alone.  Several zips
+are transferred at once, each on its own SFTP connection, and every zip is
+read from SFTP straight into an S3 multipart upload without a local copy,
+holding at most one part of each zip in memory.
+
+Each part is sent with its Content-MD5, and once the upload is complete the
+object's size is compared with the remote file and its ETag with the ETag
+computed from the parts.  Only then is the remote file removed.  A failed
+transfer aborts the multipart upload and leaves the remote file in place, so
+it is retried on the next poll.
+
+With --load, each zip is instead copied from SFTP to local disk and loaded into
+Postgres from there while the same file is uploaded to S3, rather than being
+downloaded back from S3 by the loader.  The part digests are computed during
+the SFTP copy, so the S3 ETag is known before the upload and the loads are
+recorded in the load manifest under the key and ETag that the S3 path will
+see.  The remote file is removed once the S3 copy is verified, even if the
+load fails: the load is then retried from S3 by the regular incremental run.
+
+Usage:
+    python sftp_feed_ingest.py                 # poll every minute
+    python sftp_feed_ingest.py --once          # transfer what is there and exit
+    python sftp_feed_ingest.py --once --load   # load straight from SFTP, archiving to S3 alongside
+
+SFTP_HOST, SFTP_USER and UBUNTU_PEMLOCATION give the SFTP login.
+'''
+
+FEED_PATTERN = 'datawarehousefeed*.zip'
+
+# Multipart part size; S3 requires at least 5MB for all but the last part
+PART_SIZE = 16 * 1024 * 1024
+
+def sftp_connect(host, user, keyfile):
+    '''Open an SFTP connection with a private key.'''
+    return pysftp.Connection(host, username=user, private_key=keyfile)
+
+def list_inbound_feeds(sftp, inbound_dir, pattern=FEED_PATTERN):
+    '''List the feed zips in the inbound folder.
+    RETURNS:
+    feeds (dict): (size, mtime) by file name
+    '''
+    return {attr.filename: (attr.st_size, attr.st_mtime) for attr in sftp.listdir_attr(inbound_dir)
+            if fnmatch.fnmatch(attr.filename, pattern)}
+
+def multipart_etag(part_digests):
+    '''The ETag S3 gives an object uploaded in parts with these MD5 digests.
+    Every multipart upload gets the '<md5>-<parts>' form, even with one part.'''
+    combined = hashlib.md5(b''.join(part_digests)).hexdigest()
+    return '{}-{}'.format(combined, len(part_digests))
+
+class SFTPPartReader(object):
+    '''Read a remote SFTP file one S3 part at a time.  The SFTP requests for a part
+    are pipelined with readv, but the next part is not requested until the
+    current one has been read, so at most one part is buffered however slow
+    the upload is.  (prefetch would queue the whole file.)'''
+
+    def __init__(self, remote, size):
+        self.remote = remote
+        self.size = size
+        self.position = 0
+
+    def read(self, size):
+        size = min(size, self.size - self.position)
+        if size <= 0:
+            return b''
+        data = b''.join(self.remote.readv([(self.position, size)]))
+        self.position += len(data)
+        return data
+
+def upload_stream_to_s3(s3_obj, stream, bucket, key, part_size=PART_SIZE):
+    '''Copy a binary stream to S3 as a multipart upload.
+    INPUTS:
+    s3_obj: The instantiated boto3 client object
+    stream (binary file-like): Read part_size bytes at a time
+    bucket (str), key (str): Where the object is written
+    RETURNS:
+    size (int): The number of bytes uploaded
+    etag (str): The ETag expected for the uploaded parts
+    '''
+    upload_id = s3_obj.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+    parts, digests, size = [], [], 0
+    try:
+        while True:
+            data = stream.read(part_size)
+            if not data and parts:
+                break
+            digest = hashlib.md5(data).digest()
+            response = s3_obj.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=len(parts) + 1,
+                                          Body=data, ContentMD5=base64.b64encode(digest).decode())
+            parts.append({'PartNumber': len(parts) + 1, 'ETag': response['ETag']})
+            digests.append(digest)
+            size += len(data)
+            if not data:
+                break
+        s3_obj.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                         MultipartUpload={'Parts': parts})
+    except Exception:
+        s3_obj.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    return size, multipart_etag(digests)
+
+def verify_upload(s3_obj, bucket, key, size, etag):
+    '''Raise IOError unless the object in S3 has the expected size and ETag.'''
+    head = s3_obj.head_object(Bucket=bucket, Key=key)
+    if head['ContentLength'] != size or head['ETag'].strip('"') != etag:
+        raise IOError('{} does not match its source: {} bytes, ETag {} (expected {} bytes, ETag {})'.format(
+            key, head['ContentLength'], head['ETag'], size, etag))
+
+def transfer_feed(connect, s3_obj, inbound_dir, filename, bucket, s3prefix, part_size=PART_SIZE, remove=True):
+    '''Stream one feed zip from SFTP to S3, verify it, then remove the remote file.
+    INPUTS:
+    connect (callable): Returns a new SFTP connection
+    s3_obj: The instantiated boto3 client object
+    inbound_dir (str): The SFTP folder holding the zip
+    filename (str): The name of the zip
+    bucket (str), s3prefix (str): The key of the upload is s3prefix + filename
+    remove (bool): Remove the remote file once the upload is verified
+    RETURNS:
+    key (str): The S3 key of the feed
+    '''
+    key = s3prefix + filename
+    remote_path = inbound_dir.rstrip('/') + '/' + filename
+    with connect() as sftp:
+        expected = sftp.stat(remote_path).st_size
+        with stage_timer('sftp_to_s3', key=key, prefix=None) as stage:
+            with sftp.open(remote_path, 'rb') as remote:
+                size, etag = upload_stream_to_s3(s3_obj, SFTPPartReader(remote, expected), bucket, key,
+                                                 part_size=part_size)
+            stage['bytes'] = size
+        if size != expected:
+            raise IOError('read {} bytes of {}, expected {}'.format(size, remote_path, expected))
+        verify_upload(s3_obj, bucket, key, size, etag)
+        if remove:
+            sftp.remove(remote_path)
+    print('Transferred {} to s3://{}/{} ({} bytes)'.format(remote_path, bucket, key, size))
+    return key
+
+def download_feed(sftp, remote_path, filename, part_size=PART_SIZE):
+    '''Copy a remote file to local disk, hashing it in S3 part sized blocks.
+    RETURNS:
+    size (int): The number of bytes copied
+    etag (str): The ETag of the file once uploaded with upload_stream_to_s3
+    '''
+    digests, size = [], 0
+    with sftp.open(remote_path, 'rb') as remote, open(filename, 'wb') as local:
+        remote.prefetch(sftp.stat(remote_path).st_size)
+        while True:
+            data = remote.read(part_size)
+            if not data and digests:
+                break
+            local.write(data)
+            digests.append(hashlib.md5(data).digest())
+            size += len(data)
+            if not data:
+                break
+    return size, multipart_etag(digests)
+
+def archive_feed(s3_obj, filename, bucket, key, size, etag, part_size=PART_SIZE):
+    '''Upload a local feed zip to S3 and verify it against the expected size and ETag.'''
+    with stage_timer('archive', key=key, prefix=None) as stage:
+        with open(filename, 'rb') as f:
+            uploaded, _ = upload_stream_to_s3(s3_obj, f, bucket, key, part_size=part_size)
+        stage['bytes'] = uploaded
+    verify_upload(s3_obj, bucket, key, size, etag)
+
+def transfer_and_load_feed(connect, s3_obj, inbound_dir, filename, bucket, s3prefix, load, location,
+                           part_size=PART_SIZE, remove=True):
+    '''Copy one feed zip from SFTP to local disk, then load it into Postgres and
+    archive it to S3 at the same time.
+    INPUTS:
+    load (callable): load(zip_path, key, etag) loads a local zip, e.g. load_feed_file
+    location (str): Where the local copy is written; it is removed afterwards
+    Other inputs as for transfer_feed
+    RETURNS:
+    key (str): The S3 key of the feed
+    '''
+    key = s3prefix + filename
+    remote_path = inbound_dir.rstrip('/') + '/' + filename
+    fd, zip_path = tempfile.mkstemp(prefix='athena_', suffix='.zip', dir=location)
+    os.close(fd)
+    try:
+        with connect() as sftp:
+            expected = sftp.stat(remote_path).st_size
+            with stage_timer('sftp_download', key=key, prefix=None) as stage:
+                size, etag = download_feed(sftp, remote_path, zip_path, part_size=part_size)
+                stage['bytes'] = size
+            if size != expected:
+                raise IOError('read {} bytes of {}, expected {}'.format(size, remote_path, expected))
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            archived = executor.submit(archive_feed, s3_obj, zip_path, bucket, key, size, etag, part_size)
+            try:
+                load(zip_path, key, etag)
+            except Exception as e:
+                print('Load of {} failed, it will be loaded from S3 later: {}'.format(key, e))
+            archived.result()
+        if remove:
+            # A new connection, since the download's may have timed out during the load
+            with connect() as sftp:
+                sftp.remove(remote_path)
+    finally:
+        os.remove(zip_path)
+    print('Transferred {} to s3://{}/{} ({} bytes)'.format(remote_path, bucket, key, size))
+    return key
+
+class FeedIngestService(object):
+
+    def __init__(self, connect, s3_obj, inbound_dir, bucket, s3prefix, max_workers=4, part_size=PART_SIZE, remove=True,
+                 load=None, location=None):
+        '''Poll the SFTP inbound folder and transfer stable feed zips to S3.
+        INPUTS:
+        connect (callable): Returns a new SFTP connection
+        max_workers (int): Zips transferred at once
+        load (callable or None): load(zip_path, key, etag) to load each zip from a
+        local copy, see transfer_and_load_feed
+        location (str or None): Where local copies are written when loading
+        '''
+        self.connect = connect
+        self.s3_obj = s3_obj
+        self.inbound_dir = inbound_dir
+        self.bucket = bucket
+        self.s3prefix = s3prefix
+        self.part_size = part_size
+        self.remove = remove
+        self.load = load
+        self.location = location
+        # Zips are transferred concurrently but loaded one at a time
+        self.load_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # (size, mtime) of each zip at the previous poll, the transfers under way
+        # with the (size, mtime) they started from, and the zips already transferred
+        self.last_seen = dict()
+        self.in_flight = dict()
+        self.transferred = dict()
+
+    def poll(self):
+        '''Start a transfer for every zip that is unchanged since the previous poll.
+        RETURNS:
+        started (list of strings): The file names whose transfer was started
+        '''
+        for filename, (future, stat) in list(self.in_flight.items()):
+            if future.done():
+                del self.in_flight[filename]
+                if future.exception() is not None:
+                    print('Transfer of {} failed, retrying on the next poll: {}'.format(filename, future.exception()))
+                else:
+                    self.transferred[filename] = stat
+        with self.connect() as sftp:
+            feeds = list_inbound_feeds(sftp, self.inbound_dir)
+        # Zips kept on SFTP (--keep-remote) are skipped until they change
+        self.transferred = {filename: stat for filename, stat in self.transferred.items()
+                            if feeds.get(filename) == stat}
+        started = []
+        for filename, stat in sorted(feeds.items()):
+            if filename in self.in_flight or filename in self.transferred or self.last_seen.get(filename) != stat:
+                continue
+            if self.load is None:
+                future = self.executor.submit(transfer_feed, self.connect, self.s3_obj, self.inbound_dir,
+                                              filename, self.bucket, self.s3prefix,
+                                              part_size=self.part_size, remove=self.remove)
+            else:
+                future = self.executor.submit(transfer_and_load_feed, self.connect, self.s3_obj, self.inbound_dir,
+                                              filename, self.bucket, self.s3prefix, self.locked_load, self.location,
+                                              part_size=self.part_size, remove=self.remove)
+            self.in_flight[filename] = (future, stat)
+            started.append(filename)
+        self.last_seen = feeds
+        return started
+
+    def locked_load(self, zip_path, key, etag):
+        with self.load_lock:
+            return self.load(zip_path, key, etag)
+
+    def wait(self):
+        '''Wait for the transfers under way. RETURNS: the keys that were transferred'''
+        keys = []
+        for filename, (future, stat) in list(self.in_flight.items()):
+            try:
+                keys.append(future.result())
+                self.transferred[filename] = stat
+            except Exception as e:
+                print('Transfer of {} failed: {}'.format(filename, e))
+            del self.in_flight[filename]
+        return keys
+
+    def run(self, poll_interval=60):
+        '''Poll forever.'''
+        while True:
+            self.poll()
+            time.sleep(poll_interval)
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+if __name__ == '__main__':
+    import argparse
+    from athena_load_plan import PARSE_BACKENDS
+    parser = argparse.ArgumentParser(description='Transfer Athena feed zips from SFTP to S3.')
+    parser.add_argument('--sftp-host', default=os.environ.get('SFTP_HOST', 'sftp.dispatchhealth.com'))
+    parser.add_argument('--sftp-user', default=os.environ.get('SFTP_USER', 'ubuntu'))
+    parser.add_argument('--keyfile', default=os.environ.get('UBUNTU_PEMLOCATION'))
+    parser.add_argument('--inbound-dir', default='../athenauser/inbound/')
+    parser.add_argument('--bucket', default='dispatchhealthdata')
+    parser.add_argument('--s3prefix', default='processed/athenaftp/')
+    parser.add_argument('--workers', type=int, default=4, help='Zips transferred at once')
+    parser.add_argument('--poll-interval', type=int, default=60, help='Seconds between polls')
+    parser.add_argument('--once', action='store_true', help='Transfer the zips present now and exit')
+    parser.add_argument('--settle', type=int, default=15,
+                        help='With --once, seconds a zip must stay unchanged before it is transferred')
+    parser.add_argument('--keep-remote', action='store_true', help="Don't remove transferred zips from SFTP")
+    parser.add_argument('--load', action='store_true', help='Load each zip into Postgres from its local copy')
+    parser.add_argument('--location', default='/home/ubuntu/', help='Where local copies are written with --load')
+    parser.add_argument('--feed-version', default='_17.3_')
+    parser.add_argument('--load-workers', type=int, default=4, help='Prefixes loaded at once with --load')
+    parser.add_argument('--backend', choices=PARSE_BACKENDS, default='pandas')
+    parser.add_argument('--manifest-table', default='looker_scratch.athenadwh_load_manifest')
+    parser.add_argument('--dbhost', default=os.environ.get('PGHOST', 'dashboard-clone.cylxp8fwq9cz.us-west-2.rds.amazonaws.com'))
+    parser.add_argument('--dbname', default=os.environ.get('PGDATABASE', 'dashboard'))
+    parser.add_argument('--dbschema', default='looker_scratch')
+    parser.add_argument('--dbuser', default=os.environ.get('PGUSER', 'bi_user'))
+    parser.add_argument('--dbpw', default=os.environ.get('PGPASSWORD'))
+    args = parser.parse_args()
+
+    load = None
+    if args.load:
+        import athena_file_dict
+        from athena_load_plan import compile_load_plans
+        from import_athena_csv_to_postgres import FEED_PREFIXES, INT_COLUMNS, load_feed_file
+        plans = compile_load_plans(athena_file_dict.get_dictionary(), args.dbschema, INT_COLUMNS,
+                                   chunksize=100000, backend=args.backend)
+        load = lambda zip_path, key, etag: load_feed_file(zip_path, key, etag, FEED_PREFIXES, plans, args.feed_version,
+                                                          args.load_workers, args.manifest_table, dbhost=args.dbhost,
+                                                          dbname=args.dbname, dbuser=args.dbuser, dbpw=args.dbpw,
+                                                          memory_limit=512 * 1024 * 1024)
+    connect = lambda: sftp_connect(args.sftp_host, args.sftp_user, args.keyfile)
+    service = FeedIngestService(connect, boto3.client('s3'), args.inbound_dir, args.bucket, args.s3prefix,
+                                max_workers=args.workers, remove=not args.keep_remote, load=load, location=args.location)
+    if args.once:
+        # The first poll only records the sizes, so zips still being written are skipped
+        service.poll()
+        time.sleep(args.settle)
+        service.poll()
+        service.close()
+        print_stage_metrics()
+    else:
+        service.run(args.poll_interval)
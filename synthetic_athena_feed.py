@@ -0,0 +1,142 @@
+import os
+import zipfile
+import datetime as dt
+import numpy as np
+import pandas as pd
+import athena_file_dict
+from athena_load_plan import LoadPlan
+
+'''Generate synthetic Athena datawarehousefeed zips for benchmarks and tests.
+
+Every prefix in athena_file_dict.get_dictionary() gets a CSV with the feed's
+layout: a quoted header row, three banner rows, then data rows with
+%m/%d/%Y dates, %m/%d/%Y %H:%M:%S datetimes, sparse (partly missing) IDs, and
+free text that sometimes spans several lines or holds commas, quotes, tabs and
+backslashes.  Primary key columns are unique and never missing, so the
+generated files can be upserted.
+
+The output is deterministic for a given seed.
+
+Usage:
+    python synthetic_athena_feed.py /tmp/feeds --rows 100000
+    python synthetic_athena_feed.py /tmp/feeds --rows 100000 --date 20181104 --prefix-rows document_=1000000
+'''
+
+FEED_ID = '13869'
+
+WORDS = ['take', 'one', 'tablet', 'by', 'mouth', 'daily', 'as', 'needed', 'for', 'pain', 'patient', 'reports',
+         'no', 'history', 'of', 'smoking', 'denies', 'alcohol', 'use', 'with', 'food', 'twice', 'at', 'bedtime',
+         'mg', 'follow', 'up', 'in', '2', 'weeks', 'reviewed', 'and', 'updated', 'chart', 'nurse', 'note']
+
+# Separators between words; most text is single line, some is not
+SEPARATORS = [' '] * 40 + [', ', '\n', '\r\n', ' "', '" ', '\t', ' \\ ']
+
+# Share of missing values by kind of column
+MISSING_RATE = {'id': 0.15, 'date': 0.05, 'datetime': 0.1, 'number': 0.2, 'text': 0.1}
+
+def make_text_pool(rng, size=5000):
+    '''Build a pool of free text values to sample from.'''
+    pool = []
+    for _ in range(size):
+        words = rng.choice(WORDS, rng.integers(1, 12))
+        seps = rng.choice(SEPARATORS, len(words) - 1)
+        pool.append(''.join(w + s for w, s in zip(words, seps)) + words[-1])
+    return np.array(pool, dtype=object)
+
+def with_missing(values, rate, rng):
+    '''Replace a share of the values with NaN.'''
+    values = pd.Series(values)
+    values[rng.random(len(values)) < rate] = np.nan
+    return values
+
+def make_column(col, dtype, num_rows, rng, text_pool, unique=False):
+    '''Generate the CSV values of one column.
+    INPUTS:
+    col (str): The Athena column name
+    dtype: The column's dtype from athena_file_dict
+    unique (bool): The column is a primary key: unique and never missing
+    RETURNS:
+    values (Pandas series)
+    '''
+    start = pd.Timestamp('2016-01-01')
+    if unique:
+        return pd.Series(np.arange(1, num_rows + 1) * 7 + rng.integers(0, 7))
+    if col[-8:] == 'Datetime':
+        rate = 0.9 if col.startswith('Deleted') else MISSING_RATE['datetime']
+        stamps = start + pd.to_timedelta(rng.integers(0, 1000 * 86400, num_rows), unit='s')
+        return with_missing(stamps.strftime('%m/%d/%Y %H:%M:%S'), rate, rng)
+    if col[-4:] == 'Date':
+        days = start + pd.to_timedelta(rng.integers(0, 1000, num_rows), unit='D')
+        return with_missing(days.strftime('%m/%d/%Y'), MISSING_RATE['date'], rng)
+    if col[-2:] == 'ID':
+        ids = pd.array(rng.integers(1, 10 ** 7, num_rows), dtype='Int64')
+        ids[rng.random(num_rows) < MISSING_RATE['id']] = pd.NA
+        return pd.Series(ids)
+    if dtype in ('Int64', int):
+        return pd.Series(rng.integers(0, 1000, num_rows))
+    if dtype == float:
+        return with_missing(np.round(rng.random(num_rows) * 90, 1), MISSING_RATE['number'], rng)
+    return with_missing(rng.choice(text_pool, num_rows), MISSING_RATE['text'], rng)
+
+def make_feed_csv(prefix, num_rows, seed=13869):
+    '''Build one Athena DWF CSV (header, three banner rows, data) for a prefix.
+    RETURNS:
+    data (bytes): The CSV file contents
+    '''
+    rng = np.random.default_rng(seed)
+    file_dict = athena_file_dict.get_dictionary()
+    plan = LoadPlan(file_dict, prefix)
+    primary_key = [plan.csv_columns[plan.pgcols.index(col)] for col in file_dict[prefix].get('primary_key', [])]
+    text_pool = make_text_pool(rng)
+    data = {col: make_column(col, dtype, num_rows, rng, text_pool, unique=col in primary_key)
+            for col, dtype in plan.dtypes.items()}
+    body = pd.DataFrame(data).to_csv(index=False, header=False, lineterminator='\n')
+    header = ','.join('"{}"'.format(col) for col in plan.csv_columns)
+    banner = '\n'.join(','.join(['-' * 10] * len(plan.csv_columns)) for _ in range(3))
+    return (header + '\n' + banner + '\n' + body).encode('utf-8')
+
+def feed_member_name(prefix, feed_version, stamp):
+    '''The name of a prefix's CSV inside a feed zip, e.g. provider_17.3_20181104080514_13869.csv'''
+    return '{}{}{}_{}.csv'.format(prefix.rstrip('_'), feed_version, stamp, FEED_ID)
+
+def write_feed_zip(directory, feed_date, num_rows, prefix_rows=None, feed_version='_17.3_', prefixes=None, seed=13869):
+    '''Write a synthetic datawarehousefeed zip.
+    INPUTS:
+    directory (str): Where the zip is written
+    feed_date (str): The feed date, YYYYMMDD
+    num_rows (int): Rows per prefix
+    prefix_rows (dict or None): Row counts that override num_rows for some prefixes
+    prefixes (list or None): The prefixes to include; all of athena_file_dict by default
+    RETURNS:
+    path (str): The path of the zip, named like the real feeds
+    '''
+    stamp = dt.datetime.strptime(feed_date, '%Y%m%d').strftime('%Y%m%d') + '080514'
+    path = os.path.join(directory, 'datawarehousefeed{}{}_{}.zip'.format(feed_version, stamp, FEED_ID))
+    prefix_rows = prefix_rows or dict()
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        for i, prefix in enumerate(prefixes or athena_file_dict.get_dictionary()):
+            data = make_feed_csv(prefix, prefix_rows.get(prefix, num_rows), seed=seed + i)
+            zip_ref.writestr(feed_member_name(prefix, feed_version, stamp), data)
+    return path
+
+def parse_prefix_rows(values):
+    '''Parse prefix=rows arguments into a dict.'''
+    prefix_rows = dict()
+    for value in values or []:
+        prefix, rows = value.split('=')
+        prefix_rows[prefix] = int(rows)
+    return prefix_rows
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Write a synthetic Athena datawarehousefeed zip.')
+    parser.add_argument('directory')
+    parser.add_argument('--rows', type=int, default=100000, help='Rows per prefix')
+    parser.add_argument('--prefix-rows', nargs='*', help='Per prefix row counts, e.g. document_=1000000')
+    parser.add_argument('--date', default=dt.date.today().strftime('%Y%m%d'), help='Feed date, YYYYMMDD')
+    parser.add_argument('--feed-version', default='_17.3_')
+    parser.add_argument('--seed', type=int, default=13869)
+    args = parser.parse_args()
+    os.makedirs(args.directory, exist_ok=True)
+    print(write_feed_zip(args.directory, args.date, args.rows, parse_prefix_rows(args.prefix_rows),
+                         feed_version=args.feed_version, seed=args.seed))
@@ -41,11 +41,7 @@ def get_s3_keys(s3_obj, bucket, prefix=None, substring=None):
     operation_parameters = {'Bucket': bucket,
                             'Prefix': prefix}
     page_iterator = paginator.paginate(**operation_parameters)
-    d = dict()
-    for page in page_iterator:
-        d.update(page)
-
-    key_list = [d['Contents'][k]['Key'] for k in range(len(d['Contents']))]
+    key_list = [obj['Key'] for page in page_iterator for obj in page.get('Contents', [])]
     if substring is not None:
         key_list = [sub for sub in key_list if substring in sub]
     return key_list